@@ -0,0 +1,132 @@
+# -*- coding: utf-8-*-
+"""
+    AudioClip keeps a recorded utterance in memory, so that it can be handed
+    from Mic to the STT engines without writing WAV files.
+"""
+import wave
+
+
+class AudioClip(object):
+    """
+    PCM audio in one preallocated buffer, together with its format.
+
+    Only the first `length` bytes of `data` are valid audio; the rest is
+    reserved capacity that can be filled in place (e.g. by
+    CaptureReader.read_into()) without reallocating.
+    """
+
+    def __init__(self, data=None, rate=16000, sample_width=2, channels=1,
+                 length=None):
+        """
+        Arguments:
+        data -- a bytearray holding the audio (Default: empty)
+        rate -- sample rate in Hz
+        sample_width -- bytes per sample
+        channels -- number of interleaved channels
+        length -- number of valid bytes in data (Default: all of them)
+        """
+        if data is None:
+            data = bytearray()
+        elif not isinstance(data, bytearray):
+            data = bytearray(data)
+        self.data = data
+        self.rate = rate
+        self.sample_width = sample_width
+        self.channels = channels
+        self.length = len(data) if length is None else length
+
+    @classmethod
+    def allocate(cls, capacity, rate=16000, sample_width=2, channels=1):
+        """
+        Returns an empty clip with room for capacity bytes.
+        """
+        return cls(bytearray(capacity), rate=rate, sample_width=sample_width,
+                   channels=channels, length=0)
+
+    @classmethod
+    def from_wav(cls, fp):
+        """
+        Reads a clip from a WAV file name or file object.
+        """
+        wav_fp = wave.open(fp, 'rb')
+        try:
+            return cls(wav_fp.readframes(wav_fp.getnframes()),
+                       rate=wav_fp.getframerate(),
+                       sample_width=wav_fp.getsampwidth(),
+                       channels=wav_fp.getnchannels())
+        finally:
+            wav_fp.close()
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def capacity(self):
+        return len(self.data)
+
+    @property
+    def frame_width(self):
+        return self.sample_width * self.channels
+
+    @property
+    def frames(self):
+        return self.length / self.frame_width
+
+    @property
+    def duration(self):
+        return float(self.frames) / self.rate
+
+    def _bounds(self, start, end):
+        end = self.length if end is None else min(end, self.length)
+        return (min(start, end), end)
+
+    def view(self, start=0, end=None):
+        """
+        Returns a zero-copy memoryview of the audio between two byte offsets.
+        """
+        start, end = self._bounds(start, end)
+        return memoryview(self.data)[start:end]
+
+    def buffer(self, start=0, end=None):
+        """
+        Returns a zero-copy, read-only buffer of the audio between two byte
+        offsets, for C extensions that don't support memoryviews.
+        """
+        start, end = self._bounds(start, end)
+        return buffer(self.data, start, end - start)
+
+    def bytes(self):
+        """
+        Returns a copy of the audio as str.
+        """
+        return str(self.data[:self.length])
+
+    def append(self, data):
+        """
+        Appends audio, using the reserved capacity if it suffices.
+        """
+        n = len(data)
+        self.data[self.length:self.length + n] = data
+        self.length += n
+
+    def write_wav(self, fp):
+        """
+        Writes the clip as WAV to a file name or file object.
+        """
+        wav_fp = wave.open(fp, 'wb')
+        wav_fp.setnchannels(self.channels)
+        wav_fp.setsampwidth(self.sample_width)
+        wav_fp.setframerate(self.rate)
+        wav_fp.writeframes(self.buffer())
+        wav_fp.close()
+
+
+def as_clip(audio):
+    """
+    Returns audio as AudioClip. Accepts AudioClips as well as WAV file
+    objects, for callers that still pass files.
+    """
+    if isinstance(audio, AudioClip):
+        return audio
+    audio.seek(0)
+    return AudioClip.from_wav(audio)
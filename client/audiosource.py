@@ -0,0 +1,321 @@
+# -*- coding: utf-8-*-
+"""
+    Sources of the audio captured by Mic.
+
+    A source delivers mono 16 bit audio in chunks to a callback. Besides the
+    sound card there is a source that replays WAV files, so that the
+    listening modes, the wake word engines and STT can be run and
+    benchmarked on machines without any audio hardware.
+"""
+import audioop
+import ctypes
+import logging
+import os
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+import mute_alsa
+from audioclip import AudioClip
+from player import convert
+
+# status flags passed to the source callback
+INPUT_OVERFLOW = 1
+INPUT_UNDERFLOW = 2
+
+
+class AbstractAudioSource(object):
+    """
+    Generic parent class for all audio sources.
+    """
+
+    __metaclass__ = ABCMeta
+
+    # whether the audio is captured from the room; earcons played by Mic
+    # only end up in live audio
+    LIVE = True
+
+    def __init__(self, rate=16000, chunk=1024):
+        """
+        Arguments:
+        rate -- sample rate of the delivered audio
+        chunk -- frames per chunk delivered to the callback
+        """
+        self._logger = logging.getLogger(__name__)
+        self.rate = rate
+        self.chunk = chunk
+        self.sample_width = 2
+
+    @abstractmethod
+    def start(self, callback):
+        """
+        Starts delivering audio. callback(data, status) is called with
+        every chunk from a thread owned by the source; status is a
+        combination of INPUT_OVERFLOW and INPUT_UNDERFLOW.
+        """
+        pass
+
+    @abstractmethod
+    def stop(self):
+        pass
+
+    @abstractmethod
+    def is_active(self):
+        pass
+
+    def close(self):
+        """
+        Releases the resources of the source for good.
+        """
+        self.stop()
+
+
+class PyAudioSource(AbstractAudioSource):
+    """
+    Captures from the default input device through PortAudio.
+    """
+
+    SLUG = 'pyaudio'
+
+    def __init__(self, rate=16000, chunk=1024):
+        super(self.__class__, self).__init__(rate=rate, chunk=chunk)
+        if pyaudio is None:
+            raise ImportError("PyAudio is not installed")
+        self._logger.info("Initializing PyAudio. ALSA/Jack error messages " +
+                          "that pop up during this process are normal and " +
+                          "can usually be safely ignored.")
+        try:
+            asound = ctypes.cdll.LoadLibrary('libasound.so.2')
+            asound.snd_lib_error_set_handler(mute_alsa.c_error_handler)
+        except OSError:
+            pass
+        self._audio = pyaudio.PyAudio()
+        self._stream = None
+        self._callback = None
+        self._logger.info("Initialization of PyAudio completed.")
+
+    @property
+    def audio(self):
+        """
+        The pyaudio.PyAudio instance, for opening output streams on the same
+        PortAudio instance.
+        """
+        return self._audio
+
+    def _open(self):
+        return self._audio.open(format=pyaudio.paInt16,
+                                channels=1,
+                                rate=self.rate,
+                                input=True,
+                                frames_per_buffer=self.chunk,
+                                stream_callback=self._on_audio)
+
+    def _on_audio(self, in_data, frame_count, time_info, status):
+        flags = 0
+        if status & pyaudio.paInputOverflow:
+            flags |= INPUT_OVERFLOW
+        if status & pyaudio.paInputUnderflow:
+            flags |= INPUT_UNDERFLOW
+        self._callback(in_data, flags)
+        return (None, pyaudio.paContinue)
+
+    def start(self, callback):
+        if self._stream is not None:
+            return
+        self._callback = callback
+        try:
+            self._stream = self._open()
+        except Exception, e:
+            self._logger.error(e)
+            # the audio device may have gone away, start over with a fresh
+            # PortAudio instance
+            self._audio.terminate()
+            self._audio = pyaudio.PyAudio()
+            self._stream = self._open()
+        self._stream.start_stream()
+
+    def stop(self):
+        if self._stream is None:
+            return
+        try:
+            self._stream.stop_stream()
+            self._stream.close()
+        except Exception, e:
+            self._logger.debug(e)
+        self._stream = None
+
+    def is_active(self):
+        stream = self._stream
+        try:
+            return stream is not None and stream.is_active()
+        except Exception, e:
+            self._logger.debug(e)
+            return False
+
+    def close(self):
+        self.stop()
+        self._audio.terminate()
+
+
+class WavFileSource(AbstractAudioSource):
+    """
+    Replays a corpus of WAV files as if it was spoken into the microphone.
+
+    The files are converted to the capture format and delivered one after
+    another, separated by `gap` seconds of silence. Chunks are paced
+    against the time the replay started, so the chunk boundaries and the
+    audio are the same on every run. Once the corpus is exhausted the
+    source keeps delivering silence (or starts over, if `loop` is set) and
+    sets the `finished` event.
+    """
+
+    SLUG = 'wav'
+    LIVE = False
+
+    def __init__(self, files, rate=16000, chunk=1024, speed=1.0, gap=1.0,
+                 loop=False, noise=None, noise_gain=0.1):
+        """
+        Arguments:
+        files -- WAV file names, or directories of WAV files
+        rate -- sample rate of the delivered audio
+        chunk -- frames per chunk delivered to the callback
+        speed -- playback speed relative to real time, e.g. 4 replays a
+                 minute of audio in 15 seconds
+        gap -- seconds of silence before each file
+        loop -- start over at the end of the corpus
+        noise -- WAV file with background noise that is mixed (looped) into
+                 the whole replay, including the gaps
+        noise_gain -- factor applied to the noise before mixing
+        """
+        super(self.__class__, self).__init__(rate=rate, chunk=chunk)
+        if isinstance(files, basestring):
+            files = [files]
+        self.files = []
+        for path in files:
+            if os.path.isdir(path):
+                self.files.extend(os.path.join(path, name)
+                                  for name in sorted(os.listdir(path))
+                                  if name.lower().endswith('.wav'))
+            else:
+                self.files.append(path)
+        if speed <= 0:
+            raise ValueError("Replay speed must be positive")
+        self.speed = speed
+        self.gap = gap
+        self.loop = loop
+        self.noise = None
+        if noise:
+            self.noise = self._load(noise).bytes()
+            if noise_gain != 1:
+                self.noise = audioop.mul(self.noise, self.sample_width,
+                                         noise_gain)
+        self._noise_pos = 0
+        self._thread = None
+        self._running = False
+        self.finished = threading.Event()
+
+    def _load(self, path):
+        return convert(AudioClip.from_wav(path), self.rate, 1,
+                       self.sample_width)
+
+    def _corpus(self):
+        gap = '\0' * (int(self.gap * self.rate) * self.sample_width)
+        while True:
+            for path in self.files:
+                self._logger.debug("Replaying '%s'", path)
+                yield gap
+                yield self._load(path).bytes()
+            if not self.loop:
+                return
+
+    def _chunks(self):
+        size = self.chunk * self.sample_width
+        pending = ''
+        for data in self._corpus():
+            data = pending + data
+            offset = 0
+            while len(data) - offset >= size:
+                yield data[offset:offset + size]
+                offset += size
+            pending = data[offset:]
+        self.finished.set()
+        silence = '\0' * size
+        if pending:
+            yield pending + silence[len(pending):]
+        while True:
+            yield silence
+
+    def _mix(self, data):
+        if not self.noise:
+            return data
+        noise = ''
+        while len(noise) < len(data):
+            n = len(data) - len(noise)
+            noise += self.noise[self._noise_pos:self._noise_pos + n]
+            self._noise_pos = (self._noise_pos + n) % len(self.noise)
+        return audioop.add(data, noise, self.sample_width)
+
+    def _run(self, callback):
+        chunk_time = float(self.chunk) / self.rate
+        started = time.time()
+        for index, data in enumerate(self._chunks()):
+            if not self._running:
+                break
+            delay = started + (index + 1) * chunk_time / self.speed - \
+                time.time()
+            if delay > 0:
+                time.sleep(delay)
+            callback(self._mix(data), 0)
+
+    def start(self, callback):
+        if self.is_active():
+            return
+        self._running = True
+        self.finished.clear()
+        self._noise_pos = 0
+        self._thread = threading.Thread(target=self._run, args=(callback,),
+                                        name='wav-source')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None and \
+           self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def is_active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+
+def get_source_by_slug(slug):
+    """
+    Returns:
+        An audio source class with the given slug
+
+    Arguments:
+        slug -- the slug of the audio source
+    """
+    if not slug or type(slug) is not str:
+        raise TypeError("Invalid slug '%s'", slug)
+
+    selected_sources = filter(lambda source: hasattr(source, "SLUG") and
+                              source.SLUG == slug, get_sources())
+    if len(selected_sources) == 0:
+        raise ValueError("No audio source found for slug '%s'" % slug)
+    else:
+        if len(selected_sources) > 1:
+            print(("WARNING: Multiple audio sources found for slug '%s'. " +
+                   "This is most certainly a bug.") % slug)
+        return selected_sources[0]
+
+
+def get_sources():
+    return [source for source in AbstractAudioSource.__subclasses__()
+            if hasattr(source, 'SLUG') and source.SLUG]
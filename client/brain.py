@@ -2,6 +2,11 @@
 import logging
 import pkgutil
 import dingdangpath
+import prerender
+
+# said when a plugin fails
+ERROR_REPLY = u"抱歉，我的大脑出故障了，晚点再试试吧"
+prerender.register(ERROR_REPLY)
 
 
 class Brain(object):
@@ -96,8 +101,7 @@ class Brain(object):
                     except Exception:
                         self._logger.error('Failed to execute plugin',
                                            exc_info=True)
-                        reply = u"抱歉，我的大脑出故障了，晚点再试试吧"
-                        self.mic.say(reply)
+                        self.mic.say(ERROR_REPLY)
                     else:
                         self._logger.debug("Handling of phrase '%s' by " +
                                            "plugin '%s' completed", text,
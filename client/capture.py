@@ -0,0 +1,489 @@
+# -*- coding: utf-8-*-
+"""
+    A single long-lived capture stream that is shared by all of Mic's
+    listening modes.
+
+    The audio source (see audiosource.py) delivers the audio through a
+    callback to a dedicated capture thread, which writes it into a
+    fixed-size ring buffer. Every listening mode reads from that buffer
+    through its own CaptureReader, so the input device is opened exactly
+    once.
+"""
+import collections
+import logging
+import os
+import Queue
+import threading
+import time
+
+import audiosource
+
+
+class RingBuffer(object):
+    """
+    Fixed-size circular byte buffer.
+
+    Data is addressed by its absolute position in the stream (the total
+    number of bytes ever written), so that several readers can consume the
+    same audio independently of each other.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._data = bytearray(size)
+        self._end = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def position(self):
+        """
+        The absolute position right after the newest byte
+        """
+        return self._end
+
+    @property
+    def oldest(self):
+        """
+        The absolute position of the oldest byte still held
+        """
+        return max(0, self._end - self._size)
+
+    def write(self, data):
+        with self._cond:
+            n = len(data)
+            if n > self._size:
+                data = data[n - self._size:]
+                self._end += n - self._size
+                n = self._size
+            offset = self._end % self._size
+            first = min(n, self._size - offset)
+            self._data[offset:offset + first] = data[:first]
+            if first < n:
+                self._data[:n - first] = data[first:]
+            self._end += n
+            self._cond.notify_all()
+
+    def _wait(self, pos, size, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while self._end < pos + size and not self._closed:
+            if deadline is None:
+                self._cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        pos = max(pos, self.oldest)
+        return (pos, min(pos + size, self._end))
+
+    def read(self, pos, size, timeout=None):
+        """
+        Reads size bytes starting at the absolute position pos. Blocks until
+        enough data is available, the timeout expires or the buffer is
+        closed; in the latter two cases fewer bytes may be returned.
+
+        Returns a tuple (data, pos), where pos is the position right after
+        the returned data. If the requested position has already been
+        overwritten, reading resumes at the oldest byte still held.
+        """
+        with self._cond:
+            start, end = self._wait(pos, size, timeout)
+            return (self._copy(start, end), end)
+
+    def read_into(self, pos, dest, offset, size, timeout=None):
+        """
+        Like read(), but copies the data straight into the bytearray dest
+        at offset instead of returning a new string.
+
+        Returns a tuple (count, pos) with the number of bytes copied.
+        """
+        with self._cond:
+            start, end = self._wait(pos, size, timeout)
+            n = end - start
+            if n <= 0:
+                return (0, end)
+            ring_offset = start % self._size
+            first = min(n, self._size - ring_offset)
+            view = memoryview(self._data)
+            dest[offset:offset + first] = \
+                view[ring_offset:ring_offset + first]
+            if first < n:
+                dest[offset + first:offset + n] = view[:n - first]
+            return (n, end)
+
+    def _copy(self, start, end):
+        if end <= start:
+            return ''
+        offset = start % self._size
+        n = end - start
+        if offset + n <= self._size:
+            return str(self._data[offset:offset + n])
+        first = self._size - offset
+        return str(self._data[offset:]) + str(self._data[:n - first])
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def reopen(self):
+        with self._cond:
+            self._closed = False
+
+
+class CaptureReader(object):
+    """
+    A read cursor into an AudioCapture. It mimics the read()/close()
+    interface of a blocking pyaudio.Stream, so listening loops don't need to
+    know that the device is shared.
+    """
+
+    def __init__(self, capture, position):
+        self._capture = capture
+        self.position = position
+
+    def _check_overrun(self):
+        if self.position < self._capture.ring.oldest:
+            self._capture._counters['reader_overruns'] += 1
+            self._capture._logger.warning("Capture reader fell behind, " +
+                                          "%d bytes of audio lost",
+                                          self._capture.ring.oldest -
+                                          self.position)
+
+    def read(self, num_frames, exception_on_overflow=False):
+        size = num_frames * self._capture.sample_width
+        self._check_overrun()
+        data, self.position = self._capture.ring.read(
+            self.position, size, timeout=self._capture.read_timeout)
+        if len(data) < size:
+            self._capture.check()
+        return data
+
+    @property
+    def backlog(self):
+        """
+        Number of captured bytes that have not been read yet
+        """
+        return self._capture.ring.position - self.position
+
+    def skip(self, num_frames):
+        """
+        Advances past num_frames frames without copying them.
+        """
+        ring = self._capture.ring
+        size = num_frames * self._capture.sample_width
+        with ring._cond:
+            start, self.position = ring._wait(self.position, size,
+                                              self._capture.read_timeout)
+        if self.position - start < size:
+            self._capture.check()
+
+    def read_into(self, buf, offset, num_frames):
+        """
+        Reads num_frames frames straight into the bytearray buf at offset.
+
+        Returns the number of bytes read.
+        """
+        size = num_frames * self._capture.sample_width
+        self._check_overrun()
+        n, self.position = self._capture.ring.read_into(
+            self.position, buf, offset, size,
+            timeout=self._capture.read_timeout)
+        if n < size:
+            self._capture.check()
+        return n
+
+    def close(self):
+        self._capture = None
+
+
+class Frame(collections.namedtuple('Frame', ['timestamp', 'data'])):
+    """
+    A captured chunk of audio and the wall clock time it was captured at.
+    """
+    __slots__ = ()
+
+
+class Subscription(object):
+    """
+    A bounded queue of captured frames for one consumer. If the consumer
+    falls behind, new frames are dropped and counted instead of blocking
+    the capture thread.
+    """
+
+    def __init__(self, capture, maxsize):
+        self._capture = capture
+        self._queue = Queue.Queue(maxsize)
+        self.dropped = 0
+
+    def _put(self, frame):
+        try:
+            self._queue.put_nowait(frame)
+        except Queue.Full:
+            self.dropped += 1
+
+    def get(self, timeout=None):
+        """
+        Returns the next Frame, or None if none arrived within timeout.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        if self._capture is not None:
+            self._capture.unsubscribe(self)
+            self._capture = None
+
+
+class AudioCapture(object):
+    """
+    Keeps one input stream open for the lifetime of Dingdang.
+
+    The audio source callback only timestamps each chunk and pushes it into
+    a bounded queue. A dedicated capture thread drains that queue, writes
+    the audio into the ring buffer and hands it to the listeners and
+    subscribers, so no consumer can stall the audio device. Overruns,
+    underruns and queue depth are counted in stats().
+    """
+
+    # seconds between two logs of the capture stats
+    REPORT_INTERVAL = 300
+
+    def __init__(self, source, buffer_time=10, queue_size=32):
+        """
+        Arguments:
+        source -- the AbstractAudioSource to capture from
+        buffer_time -- seconds of audio kept in the ring buffer
+        queue_size -- chunks the capture queue holds before dropping audio
+        """
+        self._logger = logging.getLogger(__name__)
+        self.source = source
+        self._thread = None
+        self._running = False
+        self._started = False
+        self._lock = threading.Lock()
+        self.rate = source.rate
+        self.chunk = source.chunk
+        self.sample_width = source.sample_width
+        self.read_timeout = 2.0 * self.chunk / self.rate + 0.5
+        self.ring = RingBuffer(self.rate * self.sample_width * buffer_time)
+        self._queue = Queue.Queue(queue_size)
+        self._filters = []
+        self._listeners = []
+        self._subscriptions = []
+        self._mute_windows = []
+        self._counters = {'frames': 0,
+                          'overruns': 0,
+                          'underruns': 0,
+                          'dropped': 0,
+                          'reader_overruns': 0,
+                          'max_queue_depth': 0}
+
+    def _callback(self, data, status):
+        if status & audiosource.INPUT_OVERFLOW:
+            self._counters['overruns'] += 1
+        if status & audiosource.INPUT_UNDERFLOW:
+            self._counters['underruns'] += 1
+        try:
+            self._queue.put_nowait(Frame(time.time(), data))
+        except Queue.Full:
+            self._counters['dropped'] += 1
+
+    def _run(self):
+        try:
+            # raise the priority of this thread (Linux only, needs
+            # privileges); it is what keeps the audio flowing
+            os.nice(-10)
+        except OSError:
+            pass
+        last_report = time.time()
+        while self._running:
+            if time.time() - last_report >= self.REPORT_INTERVAL:
+                last_report = time.time()
+                self._report()
+            try:
+                frame = self._queue.get(timeout=self.read_timeout)
+            except Queue.Empty:
+                continue
+            depth = self._queue.qsize() + 1
+            if depth > self._counters['max_queue_depth']:
+                self._counters['max_queue_depth'] = depth
+            self._dispatch(frame)
+
+    def _report(self):
+        stats = self.stats()
+        lost = stats['overruns'] + stats['dropped'] + \
+            stats['reader_overruns'] + stats['subscriber_drops']
+        log = self._logger.warning if lost else self._logger.debug
+        log("Capture stats: %s", ', '.join('%s=%d' % item
+                                           for item in sorted(stats.items())))
+
+    def _dispatch(self, frame):
+        self._counters['frames'] += 1
+        if self._mute_windows and self._is_muted(frame):
+            # our own playback, keep the timeline but drop the audio
+            self.ring.write('\0' * len(frame.data))
+            return
+        for audio_filter in self._filters:
+            try:
+                frame = Frame(frame.timestamp, audio_filter(frame))
+            except Exception, e:
+                self._logger.debug(e)
+        self.ring.write(frame.data)
+        for listener in self._listeners:
+            try:
+                listener(frame.data)
+            except Exception, e:
+                self._logger.debug(e)
+        for subscription in self._subscriptions:
+            subscription._put(frame)
+
+    def _is_muted(self, frame):
+        end = frame.timestamp
+        start = end - float(len(frame.data)) / \
+            (self.rate * self.sample_width)
+        return any(s < end and start < e for s, e in self._mute_windows)
+
+    def mute(self, start, end):
+        """
+        Replaces the audio captured between two wall clock times with
+        silence and hides it from the listeners, e.g. while an earcon is
+        playing.
+        """
+        now = time.time()
+        self._mute_windows = [window for window in self._mute_windows
+                              if window[1] > now] + [(start, end)]
+
+    def add_filter(self, audio_filter):
+        """
+        Registers a function that processes every captured Frame before
+        anybody else sees it and returns the processed audio, e.g. echo
+        suppression. It runs on the capture thread.
+        """
+        self._filters = self._filters + [audio_filter]
+
+    def remove_filter(self, audio_filter):
+        self._filters = [f for f in self._filters if f is not audio_filter]
+
+    def add_listener(self, listener):
+        """
+        Registers a function that is called with every captured chunk. It
+        runs on the capture thread and must return quickly; consumers that
+        may be slow should subscribe() instead.
+        """
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        self._listeners = [l for l in self._listeners if l is not listener]
+
+    def subscribe(self, maxsize=64):
+        """
+        Returns a Subscription that receives every captured Frame from now
+        on through its own bounded queue.
+        """
+        subscription = Subscription(self, maxsize)
+        self._subscriptions = self._subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscriptions = [s for s in self._subscriptions
+                               if s is not subscription]
+
+    def stats(self):
+        """
+        Returns a dict of counters that show whether audio got lost:
+        frames -- chunks dispatched by the capture thread
+        overruns -- input overflows reported by the audio device
+        underruns -- input underflows reported by the audio device
+        dropped -- chunks dropped because the capture queue was full
+        reader_overruns -- times a reader fell out of the ring buffer
+        subscriber_drops -- chunks dropped by full subscriptions
+        queue_depth -- chunks currently waiting in the capture queue
+        max_queue_depth -- highest queue depth seen so far
+        """
+        stats = dict(self._counters)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['subscriber_drops'] = sum(s.dropped
+                                        for s in self._subscriptions)
+        return stats
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self.ring.reopen()
+            # a thread that couldn't be joined by stop() just carries on
+            self._running = True
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='capture')
+                self._thread.daemon = True
+                self._thread.start()
+            self.source.start(self._callback)
+            self._started = True
+
+    def stop(self):
+        with self._lock:
+            if not self._started:
+                return
+            self._running = False
+            self.source.stop()
+            self._started = False
+            self.ring.close()
+            # the thread may be waiting for a chunk; let it end, so that
+            # start() can't mistake it for a running one
+            thread = self._thread
+            if thread is not None and \
+               thread is not threading.current_thread():
+                thread.join(self.read_timeout + 1)
+                if not thread.is_alive():
+                    self._thread = None
+
+    def check(self):
+        """
+        Restarts the capture stream if it died underneath us.
+        """
+        if not self.source.is_active():
+            self._logger.warning("Capture stream is not active, restarting")
+            self.stop()
+            self.start()
+
+    def seconds_to_bytes(self, seconds):
+        return int(seconds * self.rate) * self.sample_width
+
+    def reader(self, preroll=0, position=None):
+        """
+        Returns a CaptureReader that starts at the newest captured audio.
+
+        Arguments:
+        preroll -- seconds of already captured audio the reader starts with
+        position -- absolute position the reader starts at instead, e.g.
+                    where the wake word ended; audio that has been
+                    overwritten since is skipped
+        """
+        self.start()
+        if position is None:
+            position = self.ring.position - self.seconds_to_bytes(preroll)
+        return CaptureReader(self, max(position, self.ring.oldest))
+
+    def copy(self, start, end):
+        """
+        Returns the captured audio between two absolute positions as one
+        contiguous bytearray.
+        """
+        start = max(start, self.ring.oldest)
+        buf = bytearray(max(end - start, 0))
+        n, _ = self.ring.read_into(start, buf, 0, len(buf), timeout=0)
+        del buf[n:]
+        return buf
@@ -3,9 +3,14 @@ import logging
 import thread
 import time
 
+import prerender
 from brain import Brain
 from notifier import Notifier
 
+# asked when nothing was understood
+PARDON = "什么?"
+prerender.register(PARDON)
+
 
 class Conversation(object):
 
@@ -78,4 +83,4 @@ class Conversation(object):
             if input:
                 self.brain.query(input)
             else:
-                self.mic.say("什么?")
+                self.mic.say(PARDON)
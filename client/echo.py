@@ -0,0 +1,237 @@
+# -*- coding: utf-8-*-
+"""
+    Suppression of Dingdang's own voice in the captured audio, so that Mic
+    can keep listening for the wake word while it is speaking.
+"""
+import audioop
+import logging
+import threading
+import time
+
+import player
+
+
+class EchoSuppressor(object):
+    """
+    A capture stage (see AudioCapture.add_filter()) that removes the
+    playback of the speaker from the captured audio, guided by the audio
+    that is being played (the reference).
+
+    The level of the reference is tracked per capture chunk and scaled by
+    the estimated coupling between loudspeaker and microphone. Captured
+    chunks that aren't clearly louder than the echo expected at that time,
+    allowing for the unknown output latency, are replaced by silence.
+    Louder chunks, i.e. somebody talking over Dingdang, pass unchanged.
+    Without a decodable reference every chunk captured during playback is
+    silenced.
+
+    The reference of streamed audio grows while the stream is decoded (see
+    play_stream()) and starts when the playback becomes audible.
+    """
+
+    def __init__(self, rate=16000, chunk=1024, sample_width=2,
+                 max_delay=0.3, tail=0.3, margin=2.0):
+        """
+        Arguments:
+        rate -- sample rate of the capture stream
+        chunk -- frames per chunk of the capture stream
+        sample_width -- bytes per sample of the capture stream
+        max_delay -- seconds the playback may lag behind start()
+        tail -- seconds after the playback that are still treated as echo
+                (reverberation)
+        margin -- factor by which a chunk must exceed the expected echo to
+                  pass as near-end speech
+        """
+        self._logger = logging.getLogger(__name__)
+        self.rate = rate
+        self.chunk = chunk
+        self.sample_width = sample_width
+        self.chunk_time = float(chunk) / rate
+        self.max_delay = max_delay
+        self.tail = tail
+        self.margin = margin
+        # ratio of echo level to reference level, adapted during playback
+        self.coupling = 1.0
+        self.suppressed = 0
+        self.passed = 0
+        self._lock = threading.Lock()
+        self._levels = None
+        self._start = None
+        self._end = None
+        # set while the reference is a stream; _playback is the
+        # player.Playback of the stream once it is decoded, and _start is
+        # moved to the time it becomes audible
+        self._streaming = False
+        self._waiting = False
+        self._playback = None
+
+    @property
+    def active(self):
+        return self._start is not None
+
+    def levels(self, data):
+        """
+        Returns the RMS level of every capture-sized chunk of data.
+        """
+        size = self.chunk * self.sample_width
+        return [audioop.rms(data[i:i + size], self.sample_width)
+                for i in xrange(0, len(data), size)]
+
+    def load(self, path):
+        """
+        Returns the reference levels of a WAV or MP3 file, or None if it
+        can't be decoded.
+        """
+        try:
+            clip = player.load(path, self.rate, 1, self.sample_width)
+        except Exception, e:
+            self._logger.debug("Can't decode playback reference '%s': %s",
+                               path, e)
+            return None
+        return self.levels(clip.buffer())
+
+    def start(self, levels):
+        """
+        Starts suppressing the echo of a playback that begins now.
+
+        Arguments:
+        levels -- the reference levels (see load()), or None if unknown
+        """
+        with self._lock:
+            self._levels = levels
+            self._start = time.time()
+            self._streaming = self._waiting = False
+            self._playback = None
+            if levels is None:
+                # lasts until stop()
+                self._end = None
+            else:
+                self._end = self._start + len(levels) * self.chunk_time + \
+                    self.max_delay + self.tail
+
+    def play_file(self, path):
+        """
+        Starts suppressing the echo of an audio file that is about to be
+        played, for use as TTS playback callback. For streamed speech (path
+        is None) the reference is built while it is decoded, see
+        play_stream().
+        """
+        if path is None:
+            return self.play_stream()
+        self.start(self.load(path))
+
+    def play_stream(self):
+        """
+        Starts suppressing the echo of streamed audio, whose reference is
+        only decoded while it plays. The echo is suppressed until stop().
+
+        Returns:
+            A function that is fed with the Playback and the decoded audio
+            of the stream (see AudioPlayer.play_stream())
+        """
+        with self._lock:
+            self._levels = []
+            self._start = time.time()
+            self._end = None
+            self._streaming = self._waiting = True
+            self._playback = None
+        return _StreamReference(self)
+
+    def extend(self, levels, playback):
+        """
+        Adds levels to the reference of the stream being played.
+
+        Arguments:
+        levels -- the reference levels of the audio decoded next
+        playback -- the player.Playback of the stream
+        """
+        with self._lock:
+            if not self._streaming:
+                return
+            if self._playback is None:
+                self._playback = playback
+            elif self._playback is not playback:
+                # a stopped stream still decoding after the next playback
+                return
+            self._levels.extend(levels)
+
+    def stop(self):
+        """
+        Ends the playback early; echo is still suppressed for the tail.
+        """
+        with self._lock:
+            if self._start is None:
+                return
+            end = time.time() + self.tail
+            if self._end is None or end < self._end:
+                self._end = end
+
+    def __call__(self, frame):
+        with self._lock:
+            start, end, levels = self._start, self._end, self._levels
+            if start is None:
+                return frame.data
+            frame_start = frame.timestamp - self.chunk_time
+            if end is not None and frame_start > end:
+                self._start = self._end = self._levels = None
+                self._logger.debug("Echo suppression: %d chunks " +
+                                   "suppressed, %d passed, coupling %.3f",
+                                   self.suppressed, self.passed,
+                                   self.coupling)
+                self.suppressed = self.passed = 0
+                return frame.data
+            if self._waiting:
+                playback = self._playback
+                if playback is None or playback.started_at is None:
+                    # nothing of the stream is audible yet
+                    return frame.data
+                start = self._start = playback.started_at
+                self._waiting = False
+        if levels is None:
+            self.suppressed += 1
+            return '\0' * len(frame.data)
+        # the reference chunks that may be audible in this frame
+        offset = frame_start - start
+        first = max(0, int((offset - self.max_delay) / self.chunk_time))
+        last = max(0, int(offset / self.chunk_time) + 2)
+        window = levels[first:last]
+        reference = max(window) if window else 0
+        level = audioop.rms(frame.data, self.sample_width)
+        if reference:
+            # follows the echo path quickly downwards but only slowly
+            # upwards, so that near-end speech barely affects it
+            ratio = float(level) / reference
+            rate = 0.5 if ratio < self.coupling else 0.01
+            self.coupling += rate * (ratio - self.coupling)
+        if level > self.coupling * reference * self.margin:
+            self.passed += 1
+            return frame.data
+        self.suppressed += 1
+        return '\0' * len(frame.data)
+
+
+class _StreamReference(object):
+    """
+    Turns the decoded audio of a stream into reference levels for an
+    EchoSuppressor, as AudioPlayer.play_stream() tap.
+    """
+
+    def __init__(self, suppressor):
+        self.suppressor = suppressor
+        self._converter = None
+        # audio short of a whole capture chunk
+        self._pending = ''
+
+    def __call__(self, playback, data):
+        suppressor = self.suppressor
+        if self._converter is None:
+            output = playback.player
+            self._converter = player.StreamConverter(
+                output.rate, output.channels, output.sample_width,
+                suppressor.rate, 1, suppressor.sample_width)
+        data = self._pending + self._converter(data)
+        size = suppressor.chunk * suppressor.sample_width
+        whole = len(data) - len(data) % size
+        self._pending = data[whole:]
+        if whole:
+            suppressor.extend(suppressor.levels(data[:whole]), playback)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8-*-
+"""
+    The HTTP client shared by all cloud engines and robots.
+
+    One requests.Session keeps a pool of keep-alive connections per host,
+    so consecutive requests to the same service skip the TCP (and TLS)
+    handshake. Every request has a connect and a read timeout, failed
+    requests are retried a bounded number of times with jittered backoff,
+    and latency and errors are counted per endpoint. Requests that aren't
+    idempotent, such as POSTs, are only retried if they can't have reached
+    the server.
+"""
+import collections
+import logging
+import os
+import random
+import threading
+import time
+import urlparse
+import requests
+import yaml
+
+try:
+    from requests.packages.urllib3.exceptions import NewConnectionError
+except ImportError:
+    # urllib3 before 1.13 doesn't tell connect errors apart
+    NewConnectionError = None
+
+import dingdangpath
+
+
+class EndpointStats(object):
+    """
+    Latency and error counters of one endpoint (host and path).
+    """
+
+    def __init__(self, size=100):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # latencies of the most recent requests, for percentiles
+        self.latencies = collections.deque(maxlen=size)
+
+    def add(self, latency, error=False):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        self.total_time += latency
+        self.max_time = max(self.max_time, latency)
+        self.latencies.append(latency)
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(fraction * len(latencies)))]
+
+    def as_dict(self):
+        return {'requests': self.requests,
+                'errors': self.errors,
+                'retries': self.retries,
+                'mean_ms': (self.total_time / self.requests * 1000
+                            if self.requests else 0.0),
+                'p50_ms': self.percentile(0.5) * 1000,
+                'p90_ms': self.percentile(0.9) * 1000,
+                'max_ms': self.max_time * 1000}
+
+
+class HttpClient(object):
+    """
+    A thin wrapper around requests.Session with timeouts, retries and
+    per-endpoint metrics. Its methods take the arguments of the requests
+    functions of the same name, plus timeout and retries overrides.
+    """
+
+    # status codes worth another try
+    RETRY_STATUSES = (500, 502, 503, 504)
+    # methods that may be repeated after they reached the server
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+    # status codes that tell a request wasn't processed
+    NOT_PROCESSED_STATUSES = (503,)
+    # seconds between two logs of the endpoint stats
+    REPORT_INTERVAL = 600
+
+    def __init__(self, connect_timeout=3.05, read_timeout=10, retries=2,
+                 backoff=0.2, pool_size=4):
+        """
+        Arguments:
+        connect_timeout -- seconds to wait for a connection
+        read_timeout -- seconds to wait for data from the server
+        retries -- times a failed request is repeated
+        backoff -- base delay before the first retry, doubled for each
+                   further one
+        pool_size -- keep-alive connections kept per host
+        """
+        self._logger = logging.getLogger(__name__)
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=8,
+                                                pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._last_report = time.time()
+
+    def _endpoint(self, url):
+        parts = urlparse.urlsplit(url)
+        return parts.netloc + parts.path
+
+    def _record(self, endpoint, latency, error=False, retry=False):
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = EndpointStats()
+            if retry:
+                stats.retries += 1
+            else:
+                stats.add(latency, error)
+            report = time.time() - self._last_report >= self.REPORT_INTERVAL
+            if report:
+                self._last_report = time.time()
+        if report:
+            self._report()
+
+    def _report(self):
+        for endpoint, stats in sorted(self.stats().items()):
+            self._logger.info("HTTP %s: %s", endpoint,
+                              ', '.join('%s=%d' % item
+                                        for item in sorted(stats.items())))
+
+    def stats(self):
+        """
+        Returns a dict mapping every endpoint to its request, error and
+        retry counts and latencies in ms.
+        """
+        with self._lock:
+            return dict((endpoint, stats.as_dict())
+                        for endpoint, stats in self._stats.items())
+
+    def _delay(self, attempt):
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    def _not_sent(e):
+        """
+        Returns True if the request that failed with e can't have reached
+        the server, because no connection was established.
+        """
+        if isinstance(e, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(e, requests.exceptions.Timeout) or \
+           NewConnectionError is None:
+            return False
+        # requests wraps urllib3's MaxRetryError, which holds the cause
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def request(self, method, url, timeout=None, retries=None,
+                idempotent=None, **kwargs):
+        """
+        Sends a request, retrying on connection errors, timeouts and server
+        errors. Requests that aren't idempotent are only retried if no
+        connection could be established or the server answered 503, so
+        that a slow server doesn't process them twice.
+
+        Arguments:
+        method -- the HTTP method
+        url -- the URL
+        timeout -- connect and read timeout, overrides the default
+        retries -- times a failed request is repeated, overrides the
+                   default
+        idempotent -- whether the request may be repeated after it reached
+                      the server (Default: depends on the method)
+
+        Returns:
+            The requests.Response of the last attempt
+
+        Raises:
+            requests.exceptions.RequestException if the last attempt failed
+            without a response
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if retries is None:
+            retries = self.retries
+        if idempotent is None:
+            idempotent = method.upper() in self.IDEMPOTENT_METHODS
+        retry_statuses = self.RETRY_STATUSES if idempotent else \
+            self.NOT_PROCESSED_STATUSES
+        endpoint = self._endpoint(url)
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                r = self._session.request(method, url, timeout=timeout,
+                                          **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout), e:
+                self._record(endpoint, time.time() - start, error=True)
+                if attempt >= retries or \
+                   not (idempotent or self._not_sent(e)):
+                    raise
+                self._logger.debug("%s %s failed (%s), retrying", method,
+                                   endpoint, e)
+            else:
+                error = r.status_code >= 400
+                self._record(endpoint, time.time() - start, error=error)
+                if r.status_code not in retry_statuses or \
+                   attempt >= retries:
+                    return r
+                self._logger.debug("%s %s returned %d, retrying", method,
+                                   endpoint, r.status_code)
+                r.close()
+            self._record(endpoint, 0, retry=True)
+            time.sleep(self._delay(attempt))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_config():
+    # FIXME: Replace this as soon as we have a config module
+    config = {}
+    profile_path = dingdangpath.config('profile.yml')
+    if os.path.exists(profile_path):
+        with open(profile_path, 'r') as f:
+            profile = yaml.safe_load(f)
+            if profile and 'http' in profile:
+                for key in ('connect_timeout', 'read_timeout', 'retries',
+                            'backoff', 'pool_size'):
+                    if key in profile['http']:
+                        config[key] = profile['http'][key]
+    return config
+
+
+def get_http_client():
+    """
+    Returns the HttpClient shared by the whole process, configured by the
+    http section of the profile.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient(**get_config())
+        return _client
@@ -2,22 +2,591 @@
 """
     The Mic class handles all interactions with the microphone and speaker.
 """
-import ctypes
+import collections
 import logging
-import tempfile
-import wave
+import os
 import audioop
+import resource
+import subprocess
+import threading
 import time
-import pyaudio
+from abc import ABCMeta, abstractmethod
+import yaml
+import audiosource
 import dingdangpath
-import mute_alsa
+from audioclip import AudioClip
+from capture import AudioCapture
+from echo import EchoSuppressor
+from player import AudioPlayer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class EnergyTracker(object):
+    """
+    Keeps the moving average of the energy scores of the last `window`
+    chunks. The scores live in a preallocated circular array and the sum is
+    updated incrementally, so adding a chunk is O(1) regardless of the
+    window size.
+    """
+
+    def __init__(self, window, initial=None, sample_width=2):
+        """
+        Arguments:
+        window -- number of chunk scores the average is taken over
+        initial -- value the window is filled with. If None, the window is
+                   seeded with the score of the first chunk.
+        sample_width -- bytes per sample of the audio data
+        """
+        self.window = window
+        self.sample_width = sample_width
+        self._scores = [0] * window
+        self._index = 0
+        self._sum = 0
+        self._seeded = False
+        if initial is not None:
+            self.reset(initial)
+
+    def reset(self, value):
+        """
+        Fills the whole window with value.
+        """
+        for i in range(self.window):
+            self._scores[i] = value
+        self._sum = value * self.window
+        self._index = 0
+        self._seeded = True
+
+    @property
+    def average(self):
+        return float(self._sum) / self.window
+
+    def score(self, data):
+        """
+        Returns the energy score (a third of the RMS) of a single chunk.
+        """
+        # audioop beats NumPy on single chunks, whose cost is dominated by
+        # the array setup; NumPy only pays off for batches (see scores())
+        return audioop.rms(data, self.sample_width) / 3
+
+    def scores(self, data, chunk):
+        """
+        Returns the energy scores of all complete chunks of `chunk` frames in
+        data, computed in a single pass.
+        """
+        size = chunk * self.sample_width
+        count = len(data) / size
+        if numpy is not None and self.sample_width == 2:
+            samples = numpy.frombuffer(data, dtype=numpy.int16,
+                                       count=count * chunk)
+            samples = samples.reshape(count, chunk).astype(numpy.float32)
+            rms = numpy.sqrt(numpy.einsum('ij,ij->i', samples, samples) /
+                             chunk)
+            return [int(value) / 3 for value in rms]
+        return [audioop.rms(data[i * size:(i + 1) * size],
+                            self.sample_width) / 3 for i in range(count)]
+
+    def add(self, score):
+        """
+        Adds a score to the window and returns the new average.
+        """
+        if not self._seeded:
+            self.reset(score)
+            return self.average
+        self._sum += score - self._scores[self._index]
+        self._scores[self._index] = score
+        self._index = (self._index + 1) % self.window
+        return self.average
+
+    def update(self, data):
+        """
+        Scores a chunk, adds it to the window and returns its score.
+        """
+        score = self.score(data)
+        self.add(score)
+        return score
+
+    def update_many(self, data, chunk):
+        """
+        Scores a batch of chunks, adds them to the window and returns their
+        scores.
+        """
+        scores = self.scores(data, chunk)
+        for score in scores:
+            self.add(score)
+        return scores
+
+
+class NoiseFloorEstimator(object):
+    """
+    Continuously estimates the background noise level of the capture
+    stream, so that a listening threshold is available at any time without
+    recording a calibration second first.
+
+    The estimate follows drops in the energy quickly but rises only slowly,
+    so short bursts of speech hardly move it while a lasting change of the
+    environment (a fan, music) is picked up within rise_time seconds. The
+    estimate is persisted to disk and reused after a restart.
+
+    The scores of the latest chunks are kept by their capture position, so
+    that listening loops reading the same audio don't score it again (see
+    score_at()).
+    """
+
+    # number of chunk scores kept for score_at()
+    HISTORY = 64
+
+    def __init__(self, path, rate=16000, chunk=1024, multiplier=2.5,
+                 rise_time=10.0, fall_time=0.5, save_interval=60,
+                 ring=None):
+        """
+        Arguments:
+        path -- file the estimate is persisted to
+        rate -- sample rate of the capture stream
+        chunk -- frames per chunk delivered to update()
+        multiplier -- factor between noise floor and listening threshold
+        rise_time -- time constant (seconds) for a rising noise level
+        fall_time -- time constant (seconds) for a falling noise level
+        save_interval -- minimum seconds between two writes to disk
+        ring -- the capture RingBuffer, to note where each scored chunk
+                ended
+        """
+        self._logger = logging.getLogger(__name__)
+        self.path = path
+        self.multiplier = multiplier
+        self.save_interval = save_interval
+        chunk_time = float(chunk) / rate
+        self._rise = min(1.0, chunk_time / rise_time)
+        self._fall = min(1.0, chunk_time / fall_time)
+        self._scorer = EnergyTracker(1)
+        self.ring = ring
+        # capture position after a chunk -> its score, and the positions
+        # in the order they were added
+        self._scores = {}
+        self._positions = collections.deque()
+        self._last_save = time.time()
+        self.floor = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                state = yaml.safe_load(f)
+            self.floor = float(state['floor'])
+            self._logger.debug("Loaded noise floor %.1f from '%s'",
+                               self.floor, self.path)
+        except Exception:
+            self._logger.warning("Can't read noise floor from '%s'",
+                                 self.path, exc_info=True)
+
+    def save(self):
+        if self.floor is None:
+            return
+        self._last_save = time.time()
+        try:
+            with open(self.path, 'w') as f:
+                yaml.safe_dump({'floor': float(self.floor),
+                                'time': self._last_save}, f)
+        except (OSError, IOError):
+            self._logger.warning("Can't write noise floor to '%s'",
+                                 self.path, exc_info=True)
+
+    def update(self, data):
+        """
+        Feeds a captured chunk into the estimate. Called on the capture
+        thread.
+        """
+        if not data.strip('\0'):
+            # muted or echo-suppressed audio says nothing about the room
+            return
+        score = self._scorer.score(data)
+        if self.ring is not None:
+            # listeners run after the chunk has been written
+            position = self.ring.position
+            self._scores[position] = score
+            self._positions.append(position)
+            if len(self._positions) > self.HISTORY:
+                del self._scores[self._positions.popleft()]
+        floor = self.floor
+        if floor is None:
+            self.floor = float(score)
+        elif score < floor:
+            self.floor = floor + (score - floor) * self._fall
+        else:
+            self.floor = floor + (score - floor) * self._rise
+
+    def score_at(self, position):
+        """
+        Returns the energy score of the captured chunk that ended at the
+        capture position, or None if it hasn't been scored (muted audio,
+        chunks of another size or too long ago).
+        """
+        return self._scores.get(position)
+
+    @property
+    def ready(self):
+        return self.floor is not None
+
+    def threshold(self):
+        """
+        Returns the current listening threshold, i.e. the noise floor times
+        the multiplier. Persists the estimate every save_interval seconds.
+        """
+        if time.time() - self._last_save > self.save_interval:
+            self.save()
+        return max(self.floor, 1.0) * self.multiplier
+
+
+class AbstractVoiceDetector(object):
+    """
+    Generic parent class for frame-level voice activity detectors.
+
+    Detectors decide for a single short frame (10-30 ms) whether it contains
+    speech. Their thresholds are in the same unit as Mic.getScore().
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, threshold, sample_width=2):
+        self.threshold = threshold
+        self.sample_width = sample_width
+        self._scorer = EnergyTracker(1, sample_width=sample_width)
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    @abstractmethod
+    def is_speech(self, frame):
+        pass
+
+
+class EnergyVoiceDetector(AbstractVoiceDetector):
+    """
+    Treats every frame louder than the threshold as speech.
+    """
+
+    SLUG = 'energy'
+
+    def is_speech(self, frame):
+        return self._scorer.score(frame) > self.threshold
+
+
+class ZeroCrossingVoiceDetector(AbstractVoiceDetector):
+    """
+    Energy detector that also accepts quieter frames if their zero-crossing
+    rate is low, as it is for voiced speech. Broadband noise (fans, hiss)
+    crosses zero much more often and is rejected.
+    """
+
+    SLUG = 'zcr'
+
+    def __init__(self, threshold, sample_width=2, max_rate=0.25):
+        super(ZeroCrossingVoiceDetector, self).__init__(threshold,
+                                                        sample_width)
+        self.max_rate = max_rate
+
+    def is_speech(self, frame):
+        score = self._scorer.score(frame)
+        if score > self.threshold:
+            return True
+        if score <= self.threshold * 0.5:
+            return False
+        samples = len(frame) / self.sample_width
+        rate = float(audioop.cross(frame, self.sample_width)) / samples
+        return rate < self.max_rate
+
+
+class SpectralFlatnessVoiceDetector(AbstractVoiceDetector):
+    """
+    Energy detector that also accepts quieter frames if their spectrum is
+    peaky (harmonic) rather than flat like noise. Requires NumPy.
+    """
+
+    SLUG = 'flatness'
+
+    def __init__(self, threshold, sample_width=2, max_flatness=0.3):
+        super(SpectralFlatnessVoiceDetector, self).__init__(threshold,
+                                                            sample_width)
+        self.max_flatness = max_flatness
+
+    @classmethod
+    def is_available(cls):
+        return numpy is not None
+
+    def is_speech(self, frame):
+        score = self._scorer.score(frame)
+        if score > self.threshold:
+            return True
+        if score <= self.threshold * 0.5:
+            return False
+        samples = numpy.frombuffer(frame, dtype=numpy.int16)
+        power = numpy.abs(numpy.fft.rfft(samples * numpy.hanning(
+            len(samples)))) ** 2 + 1e-10
+        flatness = numpy.exp(numpy.mean(numpy.log(power))) / \
+            numpy.mean(power)
+        return flatness < self.max_flatness
+
+
+def get_voice_detector_by_slug(slug):
+    """
+    Returns:
+        A voice detector class available on the current platform
+
+    Raises:
+        ValueError if no voice detector is found for slug
+    """
+    selected = [detector for detector in
+                AbstractVoiceDetector.__subclasses__()
+                if getattr(detector, 'SLUG', None) == slug]
+    if not selected:
+        raise ValueError("No voice detector found for slug '%s'" % slug)
+    detector = selected[0]
+    if not detector.is_available():
+        raise ValueError("Voice detector '%s' is not available" % slug)
+    return detector
+
+
+class Endpointer(object):
+    """
+    Decides when an utterance has ended by running a voice detector over
+    short frames.
+
+    Recording ends when
+      * no speech started within start_timeout seconds, or
+      * speech was followed by hangover seconds without speech, or
+      * the utterance reached max_length seconds.
+    """
+
+    def __init__(self, detector, rate=16000, sample_width=2, frame_ms=20,
+                 start_timeout=5, hangover=0.6, max_length=12,
+                 min_speech=0.06):
+        """
+        Arguments:
+        detector -- an AbstractVoiceDetector instance
+        rate -- sample rate of the audio
+        sample_width -- bytes per sample of the audio
+        frame_ms -- length of the frames the detector decides on
+        start_timeout -- seconds to wait for speech to start
+        hangover -- seconds of non-speech that end the utterance
+        max_length -- hard limit of the utterance in seconds
+        min_speech -- seconds of consecutive speech needed to start
+        """
+        self._logger = logging.getLogger(__name__)
+        self.detector = detector
+        self.rate = rate
+        self.max_length = max_length
+        self._frame_size = rate * frame_ms / 1000 * sample_width
+        frame_time = frame_ms / 1000.0
+        self._start_frames = int(start_timeout / frame_time)
+        self._hangover_frames = max(1, int(hangover / frame_time))
+        self._max_frames = int(max_length / frame_time)
+        self._min_speech_frames = max(1, int(min_speech / frame_time))
+        self._frame_time = frame_time
+        self._pending = ''
+        self._frames = 0
+        self._speech_run = 0
+        self._silence_run = 0
+        self._speech_end_frame = 0
+        self.speech_started = False
+        self.reason = None
+        self.decision_delay = None
+        self.decision_time = None
+
+    @property
+    def done(self):
+        return self.reason is not None
+
+    def process(self, data):
+        """
+        Feeds a chunk of audio into the endpointer.
+
+        Returns:
+            True as soon as the end of the utterance has been decided
+        """
+        if self.done:
+            return True
+        data = self._pending + str(data) if self._pending else data
+        offset = 0
+        while len(data) - offset >= self._frame_size:
+            frame = data[offset:offset + self._frame_size]
+            offset += self._frame_size
+            if self._process_frame(frame):
+                self._pending = ''
+                return True
+        self._pending = str(data[offset:])
+        return False
+
+    def _process_frame(self, frame):
+        self._frames += 1
+        if not frame.strip('\0'):
+            # muted by the capture stream while we were playing something,
+            # this is neither speech nor silence
+            return self._check_limits()
+        if self.detector.is_speech(frame):
+            self._speech_run += 1
+            self._silence_run = 0
+            if self._speech_run >= self._min_speech_frames:
+                self.speech_started = True
+        else:
+            self._speech_run = 0
+            self._silence_run += 1
+            if self._silence_run == 1:
+                self._speech_end_frame = self._frames - 1
+
+        if self.speech_started and \
+           self._silence_run >= self._hangover_frames:
+            return self._decide('endpoint')
+        return self._check_limits()
+
+    def _check_limits(self):
+        if not self.speech_started and self._frames >= self._start_frames:
+            return self._decide('timeout')
+        if self._frames >= self._max_frames:
+            return self._decide('max_length')
+        return False
+
+    def _decide(self, reason):
+        self.reason = reason
+        self.decision_time = self._frames * self._frame_time
+        if reason == 'endpoint':
+            self.decision_delay = (self._frames - self._speech_end_frame) * \
+                self._frame_time
+        self._logger.info("Endpoint '%s' decided after %.2fs of audio%s",
+                          reason, self.decision_time,
+                          '' if self.decision_delay is None else
+                          ', %d ms after speech ended' %
+                          (self.decision_delay * 1000))
+        return True
+
+
+def thread_cpu_time():
+    """
+    Returns the CPU time consumed by the calling thread, or the wall clock
+    time where per-thread accounting is not available.
+    """
+    try:
+        usage = resource.getrusage(getattr(resource, 'RUSAGE_THREAD', 1))
+    except (ValueError, resource.error):
+        return time.time()
+    return usage.ru_utime + usage.ru_stime
+
+
+class CostMeter(object):
+    """
+    Accumulates the CPU time a listening path spends per second of audio and
+    logs it every report_interval seconds of audio.
+    """
+
+    def __init__(self, name, report_interval=60):
+        self._logger = logging.getLogger(__name__)
+        self.name = name
+        self.report_interval = report_interval
+        self.cpu_time = 0.0
+        self.audio_time = 0.0
+        self._reported = 0.0
+
+    @property
+    def cost(self):
+        """
+        CPU seconds spent per second of audio
+        """
+        if not self.audio_time:
+            return 0.0
+        return self.cpu_time / self.audio_time
+
+    def add(self, cpu_time, audio_time):
+        self.cpu_time += cpu_time
+        self.audio_time += audio_time
+        if self.audio_time - self._reported >= self.report_interval:
+            self._reported = self.audio_time
+            self._logger.info("%s: %.1f ms CPU per second of audio",
+                              self.name, self.cost * 1000)
+
+
+class HotwordListener(object):
+    """
+    Feeds every captured chunk to a streaming wake word engine (see
+    AbstractSTTEngine.detect()) on the capture thread and sets an event as
+    soon as the wake word is spotted.
+
+    Detections only count while the listener is armed, i.e. while somebody
+    is waiting for the wake word. The optional callback passed to arm() is
+    called with the hotword right away on the capture thread.
+    """
+
+    def __init__(self, engine, rate=16000, sample_width=2, ring=None):
+        """
+        Arguments:
+        engine -- the passive STT engine
+        rate -- sample rate of the captured audio
+        sample_width -- bytes per sample of the captured audio
+        ring -- the capture RingBuffer, to note where the wake word ended
+        """
+        self._logger = logging.getLogger(__name__)
+        self.engine = engine
+        self.ring = ring
+        self.bytes_per_second = float(rate * sample_width)
+        self.event = threading.Event()
+        self.hotword = None
+        self.detected_at = None
+        # capture position right after the chunk the wake word ended in
+        self.position = None
+        self.armed = False
+        self.callback = None
+        self.meter = CostMeter("Streaming wake word detection")
+
+    def arm(self, callback=None):
+        self.hotword = None
+        self.detected_at = None
+        self.position = None
+        self.callback = callback
+        self.event.clear()
+        self.armed = True
+
+    def disarm(self):
+        self.armed = False
+
+    def __call__(self, data):
+        start = thread_cpu_time()
+        hotword = self.engine.detect(data)
+        self.meter.add(thread_cpu_time() - start,
+                       len(data) / self.bytes_per_second)
+        if hotword and self.armed:
+            self.armed = False
+            self.hotword = hotword
+            self.detected_at = time.time()
+            if self.ring is not None:
+                # listeners run after the chunk has been written
+                self.position = self.ring.position
+            self.event.set()
+            if self.callback is not None:
+                self.callback(hotword)
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for the wake word.
+
+        Returns:
+            True if the wake word has been detected
+        """
+        self.event.wait(timeout)
+        return self.event.is_set()
+
 
 class Mic:
     speechRec = None
     speechRec_persona = None
+    # seconds of capture muted around earcons, covering device latency
+    EARCON_MARGIN = 0.05
 
     def __init__(self, profile, speaker, passive_stt_engine,
-                 active_stt_engine):
+                 active_stt_engine, source=None):
         """
         Initiates the pocketsphinx instance.
 
@@ -28,6 +597,8 @@ class Mic:
                               mode
         acive_stt_engine -- performs STT while Dingdang is in active listen
                             mode
+        source -- the AbstractAudioSource to listen to (Default: configured
+                  by mic.source in the profile, the sound card otherwise)
         """
         self.profile = profile
         self.robot_name = u'叮当'
@@ -38,32 +609,167 @@ class Mic:
         self.passive_stt_engine = passive_stt_engine
         self.active_stt_engine = active_stt_engine
         self.dingdangpath = dingdangpath
-        self._logger.info("Initializing PyAudio. ALSA/Jack error messages " +
-                          "that pop up during this process are normal and " +
-                          "can usually be safely ignored.")
-        try:
-            asound = ctypes.cdll.LoadLibrary('libasound.so.2')
-            asound.snd_lib_error_set_handler(mute_alsa.c_error_handler)
-        except OSError:
-            pass
-        self._audio = pyaudio.PyAudio()
-        self._logger.info("Initialization of PyAudio completed.")
+        if source is None:
+            source_config = {'type': 'pyaudio'}
+            if 'mic' in profile and 'source' in profile['mic']:
+                source_config.update(profile['mic']['source'])
+            source_class = audiosource.get_source_by_slug(
+                str(source_config.pop('type')))
+            source = source_class(**source_config)
+        self._capture = AudioCapture(source)
+        self._capture.start()
         self.stop_passive = False
         self.skip_passive = False
         self.chatting_mode = False
+        self._scorer = EnergyTracker(1)
+        # capture position where the wake word spotted by passiveListen()
+        # ended; the next active listen starts there
+        self.wake_position = None
+        # seconds of audio before the start of active listening that are
+        # handed to the STT engine as well, if it doesn't follow the wake
+        # word
+        self.preroll = 0.5
+        if 'mic' in profile and 'preroll' in profile['mic']:
+            self.preroll = profile['mic']['preroll']
+        # settings of the end-of-utterance detection
+        self.endpointer_config = {'detector': 'energy',
+                                  'frame_ms': 20,
+                                  'speech_start_timeout': 5,
+                                  'hangover': 0.6,
+                                  'max_length': 12}
+        if 'mic' in profile and 'endpointer' in profile['mic']:
+            self.endpointer_config.update(profile['mic']['endpointer'])
+        # the noise floor is tracked on the capture stream all the time
+        noise_config = {}
+        if 'mic' in profile and 'noise_floor' in profile['mic']:
+            noise_config.update(profile['mic']['noise_floor'])
+        self._noise = NoiseFloorEstimator(
+            dingdangpath.config('noise_floor.yml'),
+            rate=self._capture.rate, chunk=self._capture.chunk,
+            ring=self._capture.ring, **noise_config)
+        self._capture.add_listener(self._noise.update)
+        # 'stream' spots the wake word on every captured chunk, 'energy'
+        # waits for a disturbance and transcribes it afterwards
+        hotword_mode = 'stream' if passive_stt_engine.STREAMING_HOTWORD \
+            else 'energy'
+        if 'mic' in profile and 'hotword_mode' in profile['mic']:
+            hotword_mode = profile['mic']['hotword_mode']
+        if hotword_mode == 'stream' and \
+           not passive_stt_engine.STREAMING_HOTWORD:
+            self._logger.warning("Passive STT engine '%s' can't detect " +
+                                 "hotwords in a stream, falling back to " +
+                                 "energy-gated detection",
+                                 passive_stt_engine.SLUG)
+            hotword_mode = 'energy'
+        self._hotword_listener = None
+        if hotword_mode == 'stream':
+            self._hotword_listener = HotwordListener(
+                passive_stt_engine, rate=self._capture.rate,
+                sample_width=self._capture.sample_width,
+                ring=self._capture.ring)
+            self._capture.add_listener(self._hotword_listener)
+        # barge-in keeps the wake word listener armed while Dingdang speaks
+        # and suppresses the echo of its own voice in the captured audio
+        self.barge_in = False
+        if 'mic' in profile and 'barge_in' in profile['mic']:
+            self.barge_in = profile['mic']['barge_in']
+        if self.barge_in and self._hotword_listener is None:
+            self._logger.warning("Barge-in needs streaming hotword " +
+                                 "detection, disabling it")
+            self.barge_in = False
+        self._barge_in_hotword = None
+        self._barge_in_position = None
+        self._echo = None
+        if self.barge_in and source.LIVE:
+            self._echo = EchoSuppressor(rate=self._capture.rate,
+                                        chunk=self._capture.chunk,
+                                        sample_width=self._capture.sample_width)
+            self._capture.add_filter(self._echo)
+            speaker.playback_callback = self._echo.play_file
+        self._energy_meter = CostMeter("Energy-gated wake word detection")
+        self._energy_audio_time = 0.0
+        self._pending_command = None
+        # earcons are decoded once and played on a persistent output stream
+        self._player = None
+        try:
+            if source.LIVE:
+                self._player = AudioPlayer(source.audio)
+        except Exception:
+            self._logger.warning("Can't open audio output stream, earcons " +
+                                 "will be played with the speaker",
+                                 exc_info=True)
+        else:
+            # speech is mixed into the same stream
+            speaker.player = self._player
+        self._earcons = {}
+        # the aplay process of the last earcon, without the player
+        self._earcon_process = None
+        audio_dir = dingdangpath.data('audio')
+        for name in sorted(os.listdir(audio_dir)):
+            if not name.endswith('.wav'):
+                continue
+            try:
+                if self._player is not None:
+                    clip = self._player.load(os.path.join(audio_dir, name))
+                else:
+                    clip = AudioClip.from_wav(os.path.join(audio_dir, name))
+            except Exception:
+                self._logger.debug("Can't preload earcon '%s'", name,
+                                   exc_info=True)
+                continue
+            self._earcons[name] = clip
+
+    @property
+    def player(self):
+        """
+        The player.AudioPlayer shared by earcons, speech and plugins, or
+        None if audio is played by external commands.
+        """
+        return self._player
 
     def __del__(self):
-        self._audio.terminate()
+        self._noise.save()
+        if self._player is not None:
+            self._player.close()
+        self._capture.stop()
+        self._capture.source.close()
 
     def getScore(self, data):
-        rms = audioop.rms(data, 2)
-        score = rms / 3
-        return score
+        return self._scorer.score(data)
+
+    def captureStats(self):
+        """
+        Returns the overrun, underrun and queue depth counters of the
+        capture stream (see AudioCapture.stats()).
+        """
+        return self._capture.stats()
+
+    def createEndpointer(self, THRESHOLD):
+        """
+        Creates an Endpointer as configured in the profile's
+        mic.endpointer section.
+        """
+        config = self.endpointer_config
+        detector_class = get_voice_detector_by_slug(config['detector'])
+        detector = detector_class(THRESHOLD,
+                                  sample_width=self._capture.sample_width)
+        return Endpointer(detector,
+                          rate=self._capture.rate,
+                          sample_width=self._capture.sample_width,
+                          frame_ms=config['frame_ms'],
+                          start_timeout=config['speech_start_timeout'],
+                          hangover=config['hangover'],
+                          max_length=config['max_length'])
 
     def fetchThreshold(self):
+        """
+        Returns the current listening threshold. It comes straight from the
+        noise floor estimate; only if there is none yet (first start, no
+        audio captured so far) a second of audio is recorded to seed it.
+        """
+        if self._noise.ready:
+            return self._noise.threshold()
 
-        # TODO: Consolidate variables from the next three functions
-        THRESHOLD_MULTIPLIER = 2.5
         # 取样频率
         RATE = 16000
         # pyAudio内部缓存的块的大小
@@ -72,45 +778,36 @@ class Mic:
         # number of seconds to allow to establish threshold
         THRESHOLD_TIME = 1
 
-        # prepare recording stream
-        stream = self._audio.open(format=pyaudio.paInt16,
-                                  channels=1,
-                                  rate=RATE,
-                                  input=True,
-                                  frames_per_buffer=CHUNK)
-
-        # stores the audio data
-        frames = []
-
-        # stores the lastN score values
-        lastN = [i for i in range(20)]
-
-        # calculate the long run average, and thereby the proper threshold
-        for i in range(0, RATE / CHUNK * THRESHOLD_TIME):
-            try:
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                frames.append(data)
-
-                # save this data point as a score
-                lastN.pop(0)
-                lastN.append(self.getScore(data))
-                average = sum(lastN) / len(lastN)
+        # read from the shared capture stream
+        stream = self._capture.reader()
 
-            except Exception, e:
-                self._logger.debug(e)
-                continue
+        # keeps the average score of the last 20 chunks
+        tracker = EnergyTracker(20)
 
+        # calculate the long run average, and thereby the proper threshold;
+        # muted chunks are left out, like NoiseFloorEstimator.update() does
+        audible = False
         try:
-            stream.stop_stream()
-            stream.close()
+            data = stream.read(RATE / CHUNK * THRESHOLD_TIME * CHUNK,
+                               exception_on_overflow=False)
+            size = CHUNK * self._capture.sample_width
+            data = ''.join(data[i:i + size]
+                           for i in range(0, len(data), size)
+                           if data[i:i + size].strip('\0'))
+            audible = len(data) >= size
+            tracker.update_many(data, CHUNK)
         except Exception, e:
             self._logger.debug(e)
-            pass
 
-        # this will be the benchmark to cause a disturbance over!
-        THRESHOLD = average * THRESHOLD_MULTIPLIER
+        stream.close()
 
-        return THRESHOLD
+        if audible:
+            self._noise.floor = tracker.average
+        if not self._noise.ready:
+            # nothing but silence so far, the estimator seeds itself with
+            # the first audible chunk
+            return self._noise.multiplier
+        return self._noise.threshold()
 
     def stopPassiveListen(self):
         """
@@ -121,61 +818,86 @@ class Mic:
     def passiveListen(self, PERSONA):
         """
         Listens for PERSONA in everyday sound. Times out after LISTEN_TIME, so
-        needs to be restarted.
+        needs to be restarted. The capture position where the wake word
+        ended is kept in wake_position.
         """
+        self.wake_position = None
+        if self._barge_in_hotword is not None:
+            # the wake word interrupted the last phrase Dingdang said
+            hotword = self._barge_in_hotword
+            self._barge_in_hotword = None
+            return self._acceptHotword(PERSONA, hotword,
+                                       self._barge_in_position)
 
-        THRESHOLD_MULTIPLIER = 2.5
-        RATE = 16000
-        CHUNK = 1024
+        if self._hotword_listener is not None:
+            return self._streamingPassiveListen(PERSONA)
 
-        # number of seconds to allow to establish threshold
-        THRESHOLD_TIME = 1
+        cpu_start = thread_cpu_time()
+        try:
+            return self._energyPassiveListen(PERSONA)
+        finally:
+            self._energy_meter.add(thread_cpu_time() - cpu_start,
+                                   self._energy_audio_time)
+
+    def _streamingPassiveListen(self, PERSONA):
+        """
+        Waits for the streaming wake word engine, which runs on the capture
+        thread, to spot PERSONA.
+        """
 
         # number of seconds to listen before forcing restart
         LISTEN_TIME = 10
 
-        # prepare recording stream
-        try:
-            stream = self._audio.open(format=pyaudio.paInt16, channels=1, rate=RATE, input=True,frames_per_buffer=CHUNK)
-        except Exception, e:
-            self._logger.error(e)
-            self._audio = pyaudio.PyAudio()
-            stream = self._audio.open(format=pyaudio.paInt16, channels=1, rate=RATE, input=True, frames_per_buffer=CHUNK)
-
-        # stores the audio data
-        frames = []
+        listener = self._hotword_listener
+        listener.arm()
+        deadline = time.time() + LISTEN_TIME
+        while not self.stop_passive and time.time() < deadline:
+            if listener.wait(0.1):
+                break
+        listener.disarm()
+        self.stop_passive = False
 
-        # stores the lastN score values
-        lastN = [i for i in range(30)]
+        if not listener.hotword:
+            return (None, None)
+        self._logger.debug("Hotword '%s' detected %d ms ago",
+                           listener.hotword,
+                           (time.time() - listener.detected_at) * 1000)
+        return self._acceptHotword(PERSONA, listener.hotword,
+                                   listener.position)
 
-        didDetect = False
+    def _acceptHotword(self, PERSONA, hotword, position):
+        self.wake_position = position
+        if PERSONA.upper() not in hotword.upper():
+            # a command hotword, it is answered by the next active listen
+            # without recording or transcribing anything
+            self._pending_command = hotword
+        return (self.fetchThreshold(), PERSONA)
 
-        # calculate the long run average, and thereby the proper threshold
-        for i in range(0, RATE / CHUNK * THRESHOLD_TIME):
+    def _energyPassiveListen(self, PERSONA):
+        """
+        Waits for a disturbance above the threshold and transcribes it with
+        the passive STT engine to check if PERSONA was said.
+        """
 
-            try:
-                if self.stop_passive:
-                    break
+        RATE = 16000
+        CHUNK = 1024
+        self._energy_audio_time = 0.0
 
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                frames.append(data)
+        # number of seconds to listen before forcing restart
+        LISTEN_TIME = 10
 
-                # save this data point as a score
-                lastN.pop(0)
-                lastN.append(self.getScore(data))
-                average = sum(lastN) / len(lastN)
+        # number of chunks before the disturbance that are transcribed
+        WAKE_WINDOW = 20
 
-                # this will be the benchmark to cause a disturbance over!
-                THRESHOLD = average * THRESHOLD_MULTIPLIER
+        # read from the shared capture stream
+        stream = self._capture.reader()
+        start_position = stream.position
 
-                # save some memory for sound data
-                frames = []
+        # the benchmark to cause a disturbance over, it follows the noise
+        # floor while we are listening
+        THRESHOLD = self.fetchThreshold()
 
-                # flag raised when sound disturbance detected
-                didDetect = False
-            except Exception, e:
-                self._logger.debug(e)
-                pass
+        didDetect = False
 
         # start passively listening for disturbance above threshold
         for i in range(0, RATE / CHUNK * LISTEN_TIME):
@@ -185,8 +907,11 @@ class Mic:
                     break
 
                 data = stream.read(CHUNK, exception_on_overflow=False)
-                frames.append(data)
-                score = self.getScore(data)
+                # the noise floor estimator scored the chunk already
+                score = self._noise.score_at(stream.position)
+                if score is None:
+                    score = self.getScore(data)
+                THRESHOLD = self._noise.threshold()
 
                 if score > THRESHOLD:
                     didDetect = True
@@ -195,20 +920,20 @@ class Mic:
                 self._logger.debug(e)
                 continue
 
+        self._energy_audio_time = float(stream.position - start_position) / \
+            (self._capture.rate * self._capture.sample_width)
+
         # no use continuing if no flag raised
         if not didDetect:
             print "没接收到唤醒指令"
-            try:
-                self.stop_passive = False
-                stream.stop_stream()
-                stream.close()
-            except Exception, e:
-                self._logger.debug(e)
-                pass
+            self.stop_passive = False
+            stream.close()
             return (None, None)
 
-        # cutoff any recording before this disturbance was detected
-        frames = frames[-20:]
+        # cutoff any recording before this disturbance was detected, the
+        # audio itself stays in the capture buffer until we copy it out
+        start = stream.position - WAKE_WINDOW * CHUNK * \
+            self._capture.sample_width
 
         # otherwise, let's keep recording for few seconds and save the file
         DELAY_MULTIPLIER = 1
@@ -217,42 +942,34 @@ class Mic:
             try:
                 if self.stop_passive:
                     break
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                frames.append(data)
+                stream.skip(CHUNK)
             except Exception, e:
                 self._logger.debug(e)
                 continue
 
-        # save the audio data
-        try:
-            self.stop_passive = False
-            stream.stop_stream()
-            stream.close()
-        except Exception, e:
-            self._logger.debug(e)
-            pass
-
-        with tempfile.NamedTemporaryFile(mode='w+b') as f:
-            wav_fp = wave.open(f, 'wb')
-            wav_fp.setnchannels(1)
-            wav_fp.setsampwidth(pyaudio.get_sample_size(pyaudio.paInt16))
-            wav_fp.setframerate(RATE)
-            wav_fp.writeframes(''.join(frames))
-            wav_fp.close()
-            f.seek(0)
-            frames = []
-            # check if PERSONA was said
-            transcribed = self.passive_stt_engine.transcribe(f)
+        # hand the audio over to the wake word engine
+        self.stop_passive = False
+        end = stream.position
+        clip = AudioClip(self._capture.copy(start, end),
+                         rate=self._capture.rate,
+                         sample_width=self._capture.sample_width)
+        stream.close()
+
+        # check if PERSONA was said
+        transcribed = self.passive_stt_engine.transcribe(clip)
 
         if transcribed is not None and \
            any(PERSONA in phrase for phrase in transcribed):
+            # the command follows the transcribed window, which may have
+            # been captured a while ago
+            self.wake_position = end
             return (THRESHOLD, PERSONA)
 
         return (False, transcribed)
 
     def activeListen(self, THRESHOLD=None, LISTEN=True, MUSIC=False):
         """
-            Records until a second of silence or times out after 12 seconds
+            Records until the endpointer detects the end of the utterance
 
             Returns the first matching string or None
         """
@@ -264,76 +981,167 @@ class Mic:
     def activeListenToAllOptions(self, THRESHOLD=None, LISTEN=True,
                                  MUSIC=False):
         """
-            Records until a second of silence or times out after 12 seconds
+            Records until the endpointer detects the end of the utterance
 
             Returns a list of the matching options or None
         """
 
-        RATE = 16000
-        CHUNK = 1024
-        LISTEN_TIME = 12
+        wake_position, self.wake_position = self.wake_position, None
+        if self._pending_command:
+            command, self._pending_command = self._pending_command, None
+            self._logger.info("Hotword command '%s' bypasses STT", command)
+            return [command]
 
         # check if no threshold provided
         if THRESHOLD is None:
             THRESHOLD = self.fetchThreshold()
 
-        # prepare recording stream
-        stream = self._audio.open(format=pyaudio.paInt16,
-                                  channels=1,
-                                  rate=RATE,
-                                  input=True,
-                                  frames_per_buffer=CHUNK)
+        endpointer = self.createEndpointer(THRESHOLD)
 
-        self.speaker.play(dingdangpath.data('audio', 'beep_hi.wav'))
+        # read from the shared capture stream, starting where the wake word
+        # ended, so that words spoken right after it are not lost while it
+        # is transcribed; without a wake word, start with the pre-roll
+        stream = self._capture.reader(preroll=self.preroll,
+                                      position=wake_position)
+        try:
+            return self._recordUtterance(stream, endpointer,
+                                         wake_position is not None)
+        finally:
+            stream.close()
 
-        frames = []
-        # increasing the range # results in longer pause after command
-        # generation
-        lastN = [THRESHOLD * 1.2 for i in range(40)]
+    def _recordUtterance(self, stream, endpointer, after_wake_word):
+        """
+        Records from stream until the endpointer decides that the
+        utterance has ended, feeding the active STT engine as it goes.
 
-        for i in range(0, RATE / CHUNK * LISTEN_TIME):
-            try:
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                frames.append(data)
-                score = self.getScore(data)
-                lastN.pop(0)
-                lastN.append(score)
-                average = sum(lastN) / float(len(lastN))
-                # TODO: 0.8 should not be a MAGIC NUMBER!
-                if average < THRESHOLD * 0.8:
-                    break
-            except Exception, e:
-                self._logger.error(e)
-                continue
+        Returns:
+            The hypotheses of the active STT engine
+        """
+        CHUNK = 1024
 
-        self.speaker.play(dingdangpath.data('audio', 'beep_lo.wav'))
+        # the capture stream mutes the beep, the endpointer ignores that part
+        self.playEarcon('beep_hi.wav')
 
-        # save the audio data
+        # the whole utterance is recorded into one preallocated clip
+        backlog = stream.backlog
+        clip = AudioClip.allocate(
+            backlog + self._capture.seconds_to_bytes(endpointer.max_length),
+            rate=self._capture.rate, sample_width=self._capture.sample_width)
+        clip.length = stream.read_into(clip.data, 0,
+                                       backlog / self._capture.sample_width)
+
+        # the recognizer is fed while we record, so that its result is
+        # ready right after the endpoint; a pre-roll only goes to the
+        # recognizer, as it may hold the end of the wake word, which would
+        # let the endpointer end the recording before the user speaks
+        self.active_stt_engine.start(self._capture.rate)
         try:
-            stream.stop_stream()
-            stream.close()
-        except Exception, e:
-            self._logger.debug(e)
-            pass
-
-        with tempfile.SpooledTemporaryFile(mode='w+b') as f:
-            wav_fp = wave.open(f, 'wb')
-            wav_fp.setnchannels(1)
-            wav_fp.setsampwidth(pyaudio.get_sample_size(pyaudio.paInt16))
-            wav_fp.setframerate(RATE)
-            wav_fp.writeframes(''.join(frames))
-            wav_fp.close()
-            f.seek(0)
-            frames = []
-            return self.active_stt_engine.transcribe(f)
+            self.active_stt_engine.feed(clip.buffer())
+            if after_wake_word:
+                endpointer.process(clip.buffer())
+
+            chunk_size = CHUNK * self._capture.sample_width
+            for i in range(0, (clip.capacity - clip.length) / chunk_size):
+                if endpointer.done:
+                    # the utterance ended while the wake word was checked
+                    break
+                try:
+                    start = clip.length
+                    clip.length += stream.read_into(clip.data, start, CHUNK)
+                    chunk = clip.buffer(start)
+                    partial = self.active_stt_engine.feed(chunk)
+                    if partial:
+                        self._logger.debug("Partial transcription: %r",
+                                           partial)
+                    if endpointer.process(chunk):
+                        break
+                except Exception, e:
+                    self._logger.error(e)
+                    continue
+
+            self.playEarcon('beep_lo.wav')
+        except BaseException:
+            # the engine may hold a decoder shared with the passive engine
+            self.active_stt_engine.abort()
+            raise
+        return self.active_stt_engine.finish()
 
     def say(self, phrase):
         self._logger.info(u"机器人说：%s" % phrase)
         self.stop_passive = True
-        self.speaker.say(phrase)
-        time.sleep(1)  # 避免叮当说话时误唤醒
+        if not self.barge_in:
+            self.speaker.say(phrase)
+            time.sleep(1)  # 避免叮当说话时误唤醒
+            self.stop_passive = False
+            return
+        # the wake word stays armed and cuts the playback; our own voice
+        # is kept away from it by the echo suppressor
+        listener = self._hotword_listener
+        self.speaker.interrupted = False
+        listener.arm(self._bargeIn)
+        try:
+            self.speaker.say(phrase)
+        finally:
+            listener.disarm()
+            self.speaker.interrupted = False
+            if self._echo is not None:
+                self._echo.stop()
+        if listener.hotword:
+            self._barge_in_hotword = listener.hotword
+            self._barge_in_position = listener.position
         self.stop_passive = False
 
+    def _bargeIn(self, hotword):
+        """
+        Called on the capture thread when the wake word is spotted while
+        Dingdang is speaking.
+        """
+        self.speaker.stop()
+        self._logger.info("Hotword '%s' interrupted playback, stopped " +
+                          "within %d ms", hotword,
+                          (time.time() - self._hotword_listener.detected_at) *
+                          1000)
+
+    def playEarcon(self, name):
+        """
+        Plays one of the earcons in static/audio without blocking. The
+        capture stream is muted while it is audible, so that it doesn't end
+        up in recordings or trigger the wake word. Replayed audio sources
+        can't hear earcons, so they are skipped, as are earcons that
+        couldn't be loaded.
+        """
+        if not self._capture.source.LIVE:
+            return
+        clip = self._earcons.get(name)
+        if clip is None:
+            self._logger.debug("Skipping earcon '%s', it isn't loaded", name)
+            return
+        if self._player is not None:
+            playback = self._player.play(clip)
+            self._capture.mute(playback.start - self.EARCON_MARGIN,
+                               playback.end + self.EARCON_MARGIN)
+            return
+        # without the player, aplay plays it while we go on recording
+        if self._earcon_process is not None:
+            # reaps the last one
+            self._earcon_process.poll()
+        start = time.time()
+        try:
+            with open(os.devnull, 'w') as devnull:
+                self._earcon_process = subprocess.Popen(
+                    ['aplay', dingdangpath.data('audio', name)],
+                    stdout=devnull, stderr=devnull)
+        except OSError, e:
+            self._logger.debug("Can't play earcon '%s': %s", name, e)
+            return
+        self._capture.mute(start, start + clip.duration +
+                           self.EARCON_MARGIN * 4)
+
     def play(self, src):
         # play a voice
-        self.speaker.play(src)
+        name = os.path.basename(src)
+        if os.path.dirname(os.path.abspath(src)) == \
+           dingdangpath.data('audio') and name in self._earcons:
+            self.playEarcon(name)
+        else:
+            self.speaker.play(src)
@@ -0,0 +1,509 @@
+# -*- coding: utf-8-*-
+"""
+    In-process audio playback on one persistent PyAudio output stream.
+
+    Sounds are decoded into the output format, in one go or in chunks while
+    they play, and are mixed by the stream callback, so playing them neither
+    spawns a process nor reopens the audio device. Every sound can be
+    paused, resumed, stopped and turned down through its Playback handle.
+"""
+import audioop
+import collections
+import logging
+import threading
+import time
+import wave
+
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+try:
+    import mad
+except ImportError:
+    mad = None
+
+from audioclip import AudioClip
+
+
+class StreamConverter(object):
+    """
+    Converts consecutive chunks of a stream to another rate, channel count
+    and sample width. Unlike convert() it keeps the resampling state across
+    chunks, so there are no clicks at the chunk boundaries.
+    """
+
+    def __init__(self, rate, channels, sample_width, out_rate, out_channels,
+                 out_sample_width=2):
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.out_rate = out_rate
+        self.out_channels = out_channels
+        self.out_sample_width = out_sample_width
+        self._state = None
+
+    def __call__(self, data):
+        width = self.sample_width
+        if width != self.out_sample_width:
+            data = audioop.lin2lin(data, width, self.out_sample_width)
+            width = self.out_sample_width
+        channels = self.channels
+        if channels == 2 and self.out_channels == 1:
+            data = audioop.tomono(data, width, 0.5, 0.5)
+            channels = 1
+        if self.rate != self.out_rate:
+            data, self._state = audioop.ratecv(data, width, channels,
+                                               self.rate, self.out_rate,
+                                               self._state)
+        if channels == 1 and self.out_channels == 2:
+            data = audioop.tostereo(data, width, 1, 1)
+        return data
+
+
+def convert(clip, rate, channels, sample_width=2):
+    """
+    Returns clip converted to the given rate, channel count and sample width.
+    """
+    converter = StreamConverter(clip.rate, clip.channels, clip.sample_width,
+                                rate, channels, sample_width)
+    return AudioClip(converter(clip.bytes()), rate=rate,
+                     sample_width=sample_width, channels=channels)
+
+
+def load_wav(path, rate, channels, sample_width=2):
+    """
+    Decodes a WAV file into an AudioClip in the given format.
+    """
+    clip = AudioClip.from_wav(path)
+    return convert(clip, rate, channels, sample_width)
+
+
+def load_mp3(path, rate, channels, sample_width=2):
+    """
+    Decodes an MP3 file into an AudioClip in the given format. Needs pymad.
+    """
+    if mad is None:
+        raise ImportError("pymad is not installed")
+    mf = mad.MadFile(path)
+    data = bytearray()
+    while True:
+        buf = mf.read()
+        if buf is None:
+            break
+        data.extend(buf)
+    # pymad always decodes to 16 bit stereo
+    clip = AudioClip(data, rate=mf.samplerate(), sample_width=2, channels=2)
+    return convert(clip, rate, channels, sample_width)
+
+
+def load(path, rate, channels, sample_width=2):
+    """
+    Decodes a WAV or MP3 file into an AudioClip in the given format.
+    """
+    if path.lower().endswith('.mp3'):
+        return load_mp3(path, rate, channels, sample_width)
+    return load_wav(path, rate, channels, sample_width)
+
+
+def open_stream(path):
+    """
+    Opens a WAV or MP3 file for decoding in chunks.
+
+    Returns:
+        A tuple of the rate, channels and sample width of the audio and a
+        generator of its chunks
+    """
+    if path.lower().endswith('.mp3'):
+        if mad is None:
+            raise ImportError("pymad is not installed")
+        mf = mad.MadFile(path)
+
+        def chunks():
+            while True:
+                buf = mf.read()
+                if buf is None:
+                    return
+                yield str(buf)
+        # pymad always decodes to 16 bit stereo
+        return mf.samplerate(), 2, 2, chunks()
+    wav_fp = wave.open(path, 'rb')
+
+    def chunks():
+        try:
+            while True:
+                data = wav_fp.readframes(4096)
+                if not data:
+                    return
+                yield data
+        finally:
+            wav_fp.close()
+    return (wav_fp.getframerate(), wav_fp.getnchannels(),
+            wav_fp.getsampwidth(), chunks())
+
+
+class Playback(object):
+    """
+    Handle of one sound played by an AudioPlayer. The audio is either
+    handed over at once or written bit by bit while it plays, e.g. by a
+    decoder; a playback whose buffer runs dry contributes silence until
+    more audio arrives or finish() is called.
+
+    Audio that arrives irregularly, e.g. over the network, is smoothed by a
+    jitter buffer: the playback only starts (and restarts after its buffer
+    ran dry) once `prebuffer` bytes are buffered.
+    """
+
+    def __init__(self, player, volume=1.0, max_buffer=None, prebuffer=0):
+        """
+        Arguments:
+        player -- the AudioPlayer that mixes the playback
+        volume -- factor applied to the samples
+        max_buffer -- bytes write() may buffer ahead of the playback before
+                      it blocks (Default: no limit)
+        prebuffer -- bytes buffered before the playback starts
+        """
+        self.player = player
+        self.volume = volume
+        self.max_buffer = max_buffer
+        self.prebuffer = prebuffer
+        self.paused = False
+        self.stopped = False
+        self.finished = False
+        # estimated wall clock time at which the first audio is audible
+        self.started_at = None
+        # times the buffer ran dry before the end
+        self.underruns = 0
+        self._playing = False
+        # set once the playback has ended or has been stopped
+        self.done = threading.Event()
+        # estimated wall clock times at which the sound is audible, for
+        # sounds handed over at once
+        self.start = None
+        self.end = None
+        self._lock = player._lock
+        self._space = threading.Condition(self._lock)
+        self._chunks = collections.deque()
+        self._offset = 0
+        self._buffered = 0
+
+    @property
+    def buffered(self):
+        """
+        Bytes written but not played yet.
+        """
+        with self._lock:
+            return self._buffered
+
+    def write(self, data):
+        """
+        Appends audio in the format of the player.
+
+        Returns:
+            False if the playback has been stopped, else True
+        """
+        with self._lock:
+            while self.max_buffer is not None and not self.stopped and \
+                    self._buffered >= self.max_buffer:
+                self._space.wait(0.1)
+            if self.stopped:
+                return False
+            if data:
+                self._chunks.append(data)
+                self._buffered += len(data)
+        return True
+
+    def finish(self):
+        """
+        Marks the end of the audio; the playback ends once all of it has
+        been played.
+        """
+        with self._lock:
+            self.finished = True
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def stop(self):
+        with self._lock:
+            self.stopped = True
+            self._chunks.clear()
+            self._buffered = 0
+            self._space.notify_all()
+        self.done.set()
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+    def wait(self, timeout=None):
+        """
+        Waits until the playback has ended or has been stopped.
+
+        Returns:
+            True if it has ended, False on timeout
+        """
+        # Event.wait() without timeout can't be interrupted by signals
+        end = None if timeout is None else time.time() + timeout
+        while not self.done.is_set():
+            remaining = 1.0 if end is None else min(1.0, end - time.time())
+            if remaining <= 0:
+                break
+            self.done.wait(remaining)
+        return self.done.is_set()
+
+    def _read(self, size):
+        # called by the player with the lock held
+        parts = []
+        while size > 0 and self._chunks:
+            chunk = self._chunks[0]
+            part = chunk[self._offset:self._offset + size]
+            parts.append(part)
+            size -= len(part)
+            self._offset += len(part)
+            if self._offset >= len(chunk):
+                self._chunks.popleft()
+                self._offset = 0
+        data = ''.join(parts)
+        self._buffered -= len(data)
+        self._space.notify_all()
+        return data
+
+    @property
+    def _exhausted(self):
+        return self.finished and not self._chunks
+
+
+class AudioPlayer(object):
+    """
+    Plays sounds on a persistent output stream. Sounds that are played at
+    the same time are mixed; each one is controlled through its Playback
+    handle. When nothing is playing the stream plays silence.
+    """
+
+    # seconds of decoded audio play_file() keeps ahead of the playback
+    DECODE_AHEAD = 2.0
+
+    def __init__(self, audio, rate=44100, channels=2, chunk=1024):
+        """
+        Arguments:
+        audio -- a pyaudio.PyAudio instance
+        rate -- sample rate of the output stream
+        channels -- channels of the output stream
+        chunk -- frames per buffer requested by the callback
+        """
+        self._logger = logging.getLogger(__name__)
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = 2
+        self.frame_width = self.sample_width * channels
+        self._playbacks = []
+        self._lock = threading.Lock()
+        self._stream = audio.open(format=pyaudio.paInt16,
+                                  channels=channels,
+                                  rate=rate,
+                                  output=True,
+                                  frames_per_buffer=chunk,
+                                  stream_callback=self._callback)
+        try:
+            self.latency = self._stream.get_output_latency()
+        except Exception:
+            self.latency = float(chunk) / rate
+        self._stream.start_stream()
+
+    def load(self, path):
+        """
+        Decodes a WAV or MP3 file into the format of the output stream.
+        """
+        return load(path, self.rate, self.channels, self.sample_width)
+
+    def open(self, volume=1.0, max_buffer_time=None, prebuffer_time=0):
+        """
+        Starts a playback that is fed with write() in the format of the
+        output stream.
+
+        Arguments:
+        volume -- factor applied to the samples
+        max_buffer_time -- seconds of audio write() may buffer before it
+                           blocks (Default: no limit)
+        prebuffer_time -- seconds of audio buffered before the playback
+                          starts
+        """
+        max_buffer = None
+        if max_buffer_time is not None:
+            max_buffer = int(max_buffer_time * self.rate) * self.frame_width
+        prebuffer = int(prebuffer_time * self.rate) * self.frame_width
+        playback = Playback(self, volume=volume, max_buffer=max_buffer,
+                            prebuffer=prebuffer)
+        with self._lock:
+            self._playbacks.append(playback)
+        return playback
+
+    def play(self, clip, volume=1.0):
+        """
+        Starts playing clip and returns immediately.
+
+        Returns:
+            The Playback, with the estimated times at which the clip will be
+            audible in start and end
+        """
+        if clip.rate != self.rate or clip.channels != self.channels or \
+           clip.sample_width != self.sample_width:
+            clip = convert(clip, self.rate, self.channels, self.sample_width)
+        playback = Playback(self, volume=volume)
+        playback.write(clip.bytes())
+        playback.finish()
+        playback.start = time.time() + self.latency
+        playback.end = playback.start + clip.duration
+        with self._lock:
+            self._playbacks.append(playback)
+        return playback
+
+    def play_file(self, path, volume=1.0):
+        """
+        Starts playing a WAV or MP3 file and returns immediately. The file
+        is decoded in the background, a few seconds ahead of the playback.
+
+        Returns:
+            The Playback
+
+        Raises:
+            ImportError if MP3 decoding is not available, or the errors of
+            opening the file
+        """
+        stream = open_stream(path)
+        playback = self.open(volume=volume,
+                             max_buffer_time=self.DECODE_AHEAD)
+        self._start_decoder(path, lambda: stream, playback)
+        return playback
+
+    def play_stream(self, fp, volume=1.0, prebuffer_time=0.3, tap=None):
+        """
+        Starts playing MP3 data from a file-like object, e.g. a download
+        in progress, and returns immediately. The data is decoded as it
+        arrives.
+
+        Arguments:
+        fp -- the file-like object; read() may block until data arrives
+        volume -- factor applied to the samples
+        prebuffer_time -- seconds of audio in the jitter buffer
+        tap -- called with the Playback and every chunk of decoded audio,
+               in the format of the output stream, before it is played
+
+        Returns:
+            The Playback
+
+        Raises:
+            ImportError if MP3 decoding is not available
+        """
+        if mad is None:
+            raise ImportError("pymad is not installed")
+
+        def open_mp3():
+            # reads the first frame, so it mustn't block the caller
+            mf = mad.MadFile(fp)
+
+            def chunks():
+                while True:
+                    buf = mf.read()
+                    if buf is None:
+                        return
+                    yield str(buf)
+            return mf.samplerate(), 2, 2, chunks()
+        playback = self.open(volume=volume,
+                             max_buffer_time=self.DECODE_AHEAD,
+                             prebuffer_time=prebuffer_time)
+        self._start_decoder('stream', open_mp3, playback, tap)
+        return playback
+
+    def _start_decoder(self, name, opener, playback, tap=None):
+        thread = threading.Thread(target=self._decode,
+                                  args=(name, opener, playback, tap),
+                                  name='player-decode')
+        thread.daemon = True
+        thread.start()
+
+    def _decode(self, name, opener, playback, tap=None):
+        try:
+            rate, channels, sample_width, chunks = opener()
+            converter = StreamConverter(rate, channels, sample_width,
+                                        self.rate, self.channels,
+                                        self.sample_width)
+            for data in chunks:
+                data = converter(data)
+                if tap is not None:
+                    tap(playback, data)
+                if not playback.write(data):
+                    break
+        except Exception:
+            # a stopped stream may fail when its source is closed
+            if not playback.stopped:
+                self._logger.warning("Can't decode '%s'", name,
+                                     exc_info=True)
+        finally:
+            playback.finish()
+
+    @property
+    def mp3_supported(self):
+        return mad is not None
+
+    @property
+    def busy(self):
+        with self._lock:
+            return any(not playback.paused for playback in self._playbacks)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        size = frame_count * self.frame_width
+        out = None
+        ended = []
+        with self._lock:
+            for playback in list(self._playbacks):
+                if playback.stopped or playback._exhausted:
+                    self._playbacks.remove(playback)
+                    ended.append(playback)
+                    continue
+                if playback.paused:
+                    continue
+                if not playback._playing:
+                    if playback._buffered < playback.prebuffer and \
+                       not playback.finished:
+                        continue
+                    playback._playing = True
+                data = playback._read(size)
+                if len(data) < size and not playback.finished:
+                    # buffer again before going on
+                    if playback.started_at is not None:
+                        playback.underruns += 1
+                    playback._playing = False
+                if not data:
+                    continue
+                if playback.started_at is None:
+                    playback.started_at = time.time() + self.latency
+                if len(data) < size:
+                    data += '\0' * (size - len(data))
+                if playback.volume != 1.0:
+                    data = audioop.mul(data, self.sample_width,
+                                       playback.volume)
+                if out is None:
+                    out = data
+                else:
+                    out = audioop.add(out, data, self.sample_width)
+        for playback in ended:
+            playback.done.set()
+        if out is None:
+            out = '\0' * size
+        return (out, pyaudio.paContinue)
+
+    def close(self):
+        try:
+            self._stream.stop_stream()
+            self._stream.close()
+        except Exception, e:
+            self._logger.debug(e)
+        with self._lock:
+            playbacks, self._playbacks = self._playbacks, []
+        for playback in playbacks:
+            playback.stop()
@@ -7,6 +7,10 @@ import sys
 
 WORDS = [u"PAIZHAO", u"ZHAOPIAN"]
 SLUG = "camera"
+# fixed replies, pre-rendered at startup
+PHRASES = [u"抱歉，照片目录创建失败", u"拍照失败，请检查相机是否连接正确",
+           u"拍照成功！正在发送照片到您的邮箱", u"发送成功", u"发送失败了",
+           u"请先在配置文件中开启相机拍照功能"]
 
 
 def handle(text, mic, profile):
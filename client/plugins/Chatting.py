@@ -7,6 +7,8 @@ sys.setdefaultencoding('utf8')
 # Standard module stuff
 WORDS = ["XIANLIAO"]
 SLUG = "chatting"
+# fixed replies, pre-rendered at startup
+PHRASES = [u"进入闲聊模式，现在跟我说说话吧", u"退出闲聊模式"]
 
 
 def handle(text, mic, profile):
@@ -8,6 +8,8 @@ from dateutil import parser
 
 WORDS = ["EMAIL", "INBOX"]
 SLUG = "email"
+# fixed replies, pre-rendered at startup
+PHRASES = [u"抱歉，您的邮箱账户验证失败了", u"您没有未读邮件，真棒！"]
 
 
 # 字符编码转换方法
@@ -4,6 +4,7 @@ import logging
 import sys
 import time
 import os
+import signal
 import subprocess
 import random
 import threading
@@ -14,6 +15,10 @@ sys.setdefaultencoding('utf8')
 # Standard module stuff
 WORDS = ["YINYUE","MUSIC"]
 SLUG = "music"
+# fixed replies, pre-rendered at startup
+PHRASES = ['音乐插件配置有误,启动失败', '未扫描到音乐文件', '结束播放', '上一首',
+           '下一首', '暂停播放', '继续播放', '列表循环模式', '无脑单曲模式',
+           '随机播放', '说什么?', '出了点小故障...']
 class MusicThread(threading.Thread):
     def __init__(self, files, mic, unlimited):
         threading.Thread.__init__(self)
@@ -29,6 +34,9 @@ class MusicThread(threading.Thread):
         self.current = -1
         self.size = len(files)
         self.index = random.randint(0, self.size - 1)
+        # 当前播放: 内置播放器的句柄, 或 play 进程
+        self.playback = None
+        self.process = None
 
     def run(self):
         self.current = self.index
@@ -47,7 +55,21 @@ class MusicThread(threading.Thread):
                 temp = os.path.splitext(self.files[self.index])[0].split('/')
                 self.mic.say('即将播放' + temp[len(temp) - 1])
             time.sleep(1)
-            subprocess.call('play -G -q ' + self.files[self.index], shell=True)
+            path = self.files[self.index]
+            player = self.mic.player
+            if player is not None:
+                try:
+                    self.playback = player.play_file(path)
+                except Exception:
+                    # 内置播放器只支持 wav 和 mp3
+                    self.playback = None
+            if self.playback is not None:
+                self.playback.wait()
+                self.playback = None
+            else:
+                self.process = subprocess.Popen(['play', '-G', '-q', path])
+                self.process.wait()
+                self.process = None
         except Exception, e:
             print e
         self.next(True)
@@ -82,18 +104,36 @@ class MusicThread(threading.Thread):
         self.status = False
         self.clean()
 
+    # 只控制音乐自己的播放, 不影响语音和提示音
+    def send_signal(self, sig):
+        process = self.process
+        if process is not None:
+            try:
+                process.send_signal(sig)
+            except OSError:
+                pass
+
     # 暂停播放
     def pause(self):
-        subprocess.call('pkill -STOP play', shell=True)
+        playback = self.playback
+        if playback is not None:
+            playback.pause()
+        self.send_signal(signal.SIGSTOP)
 
     # 继续播放
     def proceed(self):
-        subprocess.call('pkill -CONT play', shell=True)
+        playback = self.playback
+        if playback is not None:
+            playback.resume()
+        self.send_signal(signal.SIGCONT)
 
     # 结束当前播放
     def clean(self):
-        process = subprocess.Popen('pkill -9 play', shell=True)
-        process.wait()
+        playback = self.playback
+        if playback is not None:
+            playback.stop()
+        self.send_signal(signal.SIGCONT)
+        self.send_signal(signal.SIGKILL)
 
     # 用于控制循环模式
     def setunlimited(self):
@@ -127,17 +167,7 @@ def getfile(url,files,subdirectory,suffix):
             # 常见音频文件
             hz = os.path.splitext(url + '/' + f)[1].lower();
             if hz in suffix:
-                files.append(url + '/' + \
-                             f.replace(' ', '\ ')\
-                             .replace('(', '\(')\
-                             .replace(')', '\)')\
-                             .replace('#', '\#')\
-                             .replace('-', '\-')\
-                             .replace('$', '\$')\
-                             .replace('&', '\&')\
-                             .replace('?', '\?')\
-                             .replace('\'', '\\\'')\
-                             .replace(',', '\,'))
+                files.append(url + '/' + f)
         elif os.path.isdir(url + '/' + f) and subdirectory:  # 递归查找
             getfile(url + '/' + f,files,subdirectory,suffix)
 
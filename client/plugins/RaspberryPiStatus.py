@@ -9,6 +9,8 @@ sys.setdefaultencoding('utf8')
 
 WORDS = ["SHUMEIPAIZHUANGTAI"]
 SLUG = "pi_status"
+# fixed replies, pre-rendered at startup
+PHRASES = [u'抱歉，无法获取处理器温度', u'抱歉，我没有获取到树莓派状态']
 
 def getCPUtemperature(logger, mic):
     result = 0.0
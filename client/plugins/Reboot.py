@@ -10,6 +10,10 @@ sys.setdefaultencoding('utf8')
 
 WORDS = ["CHONGQI"]
 SLUG = "reboot"
+# fixed replies, pre-rendered at startup
+PHRASES = ['将要重新启动系统，请在滴一声后进行确认，授权相关操作',
+           '授权成功，开始进行相关操作', '授权失败，操作已取消，请重新尝试',
+           '抱歉，重新启动系统失败']
 
 def handle(text, mic, profile, wxbot=None):
     logger = logging.getLogger(__name__)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8-*-
+"""
+    Pre-rendering of the phrases Dingdang always says the same way, so that
+    they are in the TTS cache before they are needed.
+
+    Modules register their fixed replies with register(); plugins list
+    theirs in a PHRASES constant next to WORDS.
+"""
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+_phrases = []
+
+
+def register(*phrases):
+    """
+    Adds phrases to the ones that are pre-rendered at startup.
+    """
+    for phrase in phrases:
+        if phrase not in _phrases:
+            _phrases.append(phrase)
+
+
+def get_phrases(plugins=()):
+    """
+    Returns the registered phrases followed by the PHRASES of plugins.
+    """
+    phrases = list(_phrases)
+    for plugin in plugins:
+        for phrase in getattr(plugin, 'PHRASES', []):
+            if phrase not in phrases:
+                phrases.append(phrase)
+    return phrases
+
+
+class Prerenderer(threading.Thread):
+    """
+    Synthesizes phrases into the cache of a TTS engine in the background.
+    """
+
+    def __init__(self, speaker, phrases):
+        """
+        Arguments:
+        speaker -- the TTS engine, with a cache
+        phrases -- the phrases to pre-render
+        """
+        super(Prerenderer, self).__init__(name='prerender')
+        self.daemon = True
+        self.speaker = speaker
+        self.phrases = phrases
+        self.rendered = 0
+        self.failed = 0
+
+    def run(self):
+        start = time.time()
+        total = len(self.phrases)
+        for i, phrase in enumerate(self.phrases, start=1):
+            try:
+                if self.speaker.prerender(phrase):
+                    self.rendered += 1
+            except Exception:
+                self.failed += 1
+                _logger.warning(u"Can't pre-render '%s'", phrase,
+                                exc_info=True)
+            _logger.debug("Pre-rendered %d/%d phrases", i, total)
+        _logger.info("Pre-rendering done in %.1f s: %d phrases " +
+                     "synthesized, %d cached already, %d failed",
+                     time.time() - start, self.rendered,
+                     total - self.rendered - self.failed, self.failed)
+
+
+def start(speaker, phrases):
+    """
+    Starts pre-rendering phrases with speaker.
+
+    Returns:
+        The running Prerenderer, or None if speaker has no cache
+    """
+    if speaker.cache is None:
+        _logger.debug("Not pre-rendering, the TTS engine has no cache")
+        return None
+    prerenderer = Prerenderer(speaker, phrases)
+    prerenderer.start()
+    return prerenderer
@@ -1,9 +1,10 @@
 # -*- coding: utf-8-*-
-import requests
 import json
 import logging
 from uuid import getnode as get_mac
 from app_utils import sendToUser, create_reminder
+import httpclient
+import prerender
 from abc import ABCMeta, abstractmethod
 
 import sys
@@ -12,6 +13,10 @@ import sys
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
+# said when the robot service can't be reached
+FALLBACK_REPLY = "抱歉, 我的大脑短路了 请稍后再试试."
+prerender.register(FALLBACK_REPLY)
+
 
 class AbstractRobot(object):
 
@@ -61,7 +66,7 @@ class TulingRobot(AbstractRobot):
             url = "http://www.tuling123.com/openapi/api"
             userid = str(get_mac())[:32]
             body = {'key': self.tuling_key, 'info': msg, 'userid': userid}
-            r = requests.post(url, data=body)
+            r = httpclient.get_http_client().post(url, data=body)
             respond = json.loads(r.text)
             result = ''
             if respond['code'] == 100000:
@@ -101,8 +106,7 @@ class TulingRobot(AbstractRobot):
                 self.mic.skip_passive = True
         except Exception,e:
             self._logger.error(e)
-            self.mic.say("抱歉, 我的大脑短路了 " +
-                         "请稍后再试试.")
+            self.mic.say(FALLBACK_REPLY)
 
 
 class Emotibot(AbstractRobot):
@@ -153,7 +157,8 @@ class Emotibot(AbstractRobot):
                 "text": msg,
                 "location": self.location
             }
-            r = requests.post(url, params=register_data)
+            r = httpclient.get_http_client().post(url,
+                                                  params=register_data)
             jsondata = json.loads(r.text)
             result = ''
             responds = []
@@ -197,8 +202,7 @@ class Emotibot(AbstractRobot):
         except Exception:
             self._logger.critical("Emotibot failed to responsed for %r",
                                   msg, exc_info=True)
-            self.mic.say("抱歉, 我的大脑短路了 " +
-                         "请稍后再试试.")
+            self.mic.say(FALLBACK_REPLY)
 
 
 def get_robot_by_slug(slug):
@@ -0,0 +1,197 @@
+# -*- coding: utf-8-*-
+"""
+    Access tokens of the Baidu open platform, shared by all Baidu engines
+    and cached on disk across restarts.
+"""
+import logging
+import os
+import threading
+import time
+import requests
+import yaml
+
+import dingdangpath
+import httpclient
+
+
+class TokenManager(object):
+    """
+    Hands out OAuth access tokens for API key / secret key pairs.
+
+    Tokens are kept together with their expiry in memory and in a YAML
+    file, so that a restart doesn't cost a round trip. A token that is about
+    to expire is still handed out while a fresh one is fetched in the
+    background.
+    """
+
+    URL = 'http://openapi.baidu.com/oauth/2.0/token'
+    # lifetime assumed if the token response doesn't state one
+    DEFAULT_LIFETIME = 30 * 24 * 3600
+    # seconds before the expiry at which tokens are refreshed
+    REFRESH_MARGIN = 24 * 3600
+    # seconds before a failed background refresh is tried again
+    RETRY_INTERVAL = 60
+
+    def __init__(self, path):
+        """
+        Arguments:
+        path -- YAML file the tokens are persisted in
+        """
+        self._logger = logging.getLogger(__name__)
+        self.path = path
+        self._http = httpclient.get_http_client()
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+        self._refreshing = set()
+        self._failed = {}
+        self._tokens = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                tokens = yaml.safe_load(f)
+        except Exception, e:
+            self._logger.warning("Can't read tokens from '%s': %s",
+                                 self.path, e)
+            return {}
+        if not isinstance(tokens, dict):
+            return {}
+        # the file may have been edited by hand or written partially
+        valid = {}
+        for api_key, entry in tokens.items():
+            if isinstance(entry, dict) and entry.get('token') and \
+               isinstance(entry.get('expires_at'), (int, long, float)) and \
+               not isinstance(entry['expires_at'], bool):
+                valid[api_key] = entry
+            else:
+                self._logger.warning("Ignoring invalid token entry in " +
+                                     "'%s'", self.path)
+        return valid
+
+    def _save(self):
+        with self._lock:
+            tokens = dict(self._tokens)
+        tmp_path = self.path + '.tmp'
+        try:
+            # tokens grant access to the account, keep them private
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0600)
+            with os.fdopen(fd, 'w') as f:
+                yaml.safe_dump(tokens, f, default_flow_style=False)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            self._logger.warning("Can't save tokens to '%s': %s",
+                                 self.path, e)
+
+    def _cached(self, api_key):
+        with self._lock:
+            return self._tokens.get(api_key)
+
+    def _fetch_lock(self, api_key):
+        with self._lock:
+            return self._fetch_locks.setdefault(api_key, threading.Lock())
+
+    def _fetch(self, api_key, secret_key):
+        """
+        Requests a new token from the server.
+
+        Returns:
+            The new cache entry, or None if the request failed
+        """
+        params = {'grant_type': 'client_credentials',
+                  'client_id': api_key,
+                  'client_secret': secret_key}
+        requested_at = time.time()
+        try:
+            r = self._http.get(self.URL, params=params)
+            r.raise_for_status()
+            response = r.json()
+            token = response['access_token']
+        except requests.exceptions.HTTPError:
+            self._logger.critical('Token request failed with response: %r',
+                                  r.text,
+                                  exc_info=True)
+            return None
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            self._logger.critical('Token request failed.', exc_info=True)
+            return None
+        lifetime = response.get('expires_in', self.DEFAULT_LIFETIME)
+        entry = {'token': str(token),
+                 'expires_at': requested_at + lifetime}
+        with self._lock:
+            self._tokens[api_key] = entry
+            self._failed.pop(api_key, None)
+        self._save()
+        self._logger.debug("Fetched a token valid for %d days in %d ms",
+                           lifetime / (24 * 3600),
+                           (time.time() - requested_at) * 1000)
+        return entry
+
+    def get(self, api_key, secret_key):
+        """
+        Returns a valid access token, or '' if none could be fetched.
+        """
+        entry = self._cached(api_key)
+        now = time.time()
+        if entry is None or entry['expires_at'] <= now:
+            with self._fetch_lock(api_key):
+                # a background refresh may have fetched it meanwhile
+                entry = self._cached(api_key)
+                if entry is None or entry['expires_at'] <= time.time():
+                    entry = self._fetch(api_key, secret_key)
+            if entry is None:
+                return ''
+        elif entry['expires_at'] - now < self.REFRESH_MARGIN:
+            self._refresh(api_key, secret_key)
+        return entry['token']
+
+    def prewarm(self, api_key, secret_key):
+        """
+        Fetches a token in the background unless a fresh one is cached, so
+        that the first request doesn't have to wait for it.
+        """
+        entry = self._cached(api_key)
+        if entry is None or \
+           entry['expires_at'] - time.time() < self.REFRESH_MARGIN:
+            self._refresh(api_key, secret_key)
+
+    def _refresh(self, api_key, secret_key):
+        with self._lock:
+            if api_key in self._refreshing or \
+               time.time() - self._failed.get(api_key, 0) < \
+               self.RETRY_INTERVAL:
+                return
+            self._refreshing.add(api_key)
+        thread = threading.Thread(target=self._run_refresh,
+                                  args=(api_key, secret_key),
+                                  name='token-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def _run_refresh(self, api_key, secret_key):
+        try:
+            with self._fetch_lock(api_key):
+                entry = self._fetch(api_key, secret_key)
+            if entry is None:
+                with self._lock:
+                    self._failed[api_key] = time.time()
+        finally:
+            with self._lock:
+                self._refreshing.discard(api_key)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_token_manager():
+    """
+    Returns the TokenManager shared by the whole process.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = TokenManager(dingdangpath.config('baidu_tokens.yml'))
+        return _manager
@@ -0,0 +1,193 @@
+# -*- coding: utf-8-*-
+"""
+    A disk cache of synthesized speech, so that phrases Dingdang says over
+    and over are synthesized only once.
+"""
+import collections
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import unicodedata
+import yaml
+
+import dingdangpath
+
+
+class TTSCache(object):
+    """
+    Audio files of synthesized phrases, keyed by the engine, its voice
+    parameters and the text.
+
+    The files are kept in one directory. When they take up more than
+    max_size bytes, the least recently used ones are removed; the
+    modification time of a file records when it was used last, so the
+    order survives restarts.
+    """
+
+    def __init__(self, path, max_size=50 * 1024 * 1024):
+        """
+        Arguments:
+        path -- directory the audio files are kept in
+        max_size -- bytes the audio files may take up in total
+        """
+        self._logger = logging.getLogger(__name__)
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._lock = threading.Lock()
+        # key -> (file name, size), least recently used first
+        self._entries = collections.OrderedDict()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError, e:
+                self._logger.warning("Can't create TTS cache dir '%s': %s",
+                                     self.path, e)
+            return
+        files = []
+        for name in os.listdir(self.path):
+            key, ext = os.path.splitext(name)
+            filename = os.path.join(self.path, name)
+            if not ext or not os.path.isfile(filename):
+                continue
+            stat = os.stat(filename)
+            files.append((stat.st_mtime, key, filename, stat.st_size))
+        for mtime, key, filename, size in sorted(files):
+            self._entries[key] = (filename, size)
+            self.size += size
+        self._logger.debug("TTS cache holds %d phrases (%d KB)",
+                           len(self._entries), self.size / 1024)
+        self._evict()
+
+    @staticmethod
+    def key(slug, params, phrase):
+        """
+        Returns the cache key of a phrase said by an engine.
+
+        Arguments:
+        slug -- the slug of the engine
+        params -- dict of the parameters that change how the engine sounds
+        phrase -- the text; surrounding and repeated whitespace don't matter
+        """
+        if not isinstance(phrase, unicode):
+            phrase = phrase.decode('utf-8')
+        phrase = unicodedata.normalize('NFC', phrase)
+        phrase = re.sub(r'\s+', ' ', phrase).strip()
+        params = ','.join('%s=%s' % item for item in sorted(params.items()))
+        text = u'\n'.join([slug, params, phrase]).encode('utf-8')
+        return hashlib.sha1(text).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the audio file cached for key, or None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or not os.path.exists(entry[0]):
+                if entry is not None:
+                    self.size -= entry[1]
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+        try:
+            os.utime(entry[0], None)
+        except OSError:
+            pass
+        return entry[0]
+
+    def put(self, key, filename):
+        """
+        Moves an audio file into the cache.
+
+        Returns:
+            The name of the cached file, or None if it couldn't be stored
+            (the file is left where it was then)
+        """
+        ext = os.path.splitext(filename)[1]
+        target = os.path.join(self.path, key + ext)
+        try:
+            shutil.move(filename, target)
+            size = os.path.getsize(target)
+        except (IOError, OSError), e:
+            self._logger.warning("Can't store '%s' in the TTS cache: %s",
+                                 filename, e)
+            return None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (target, size)
+            self.size += size
+            self._evict()
+        return target
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def _evict(self):
+        # the most recent entry is kept even if it is too big on its own
+        while self.size > self.max_size and len(self._entries) > 1:
+            key, (filename, size) = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            self._logger.debug("Evicted '%s' from the TTS cache", filename)
+
+    def stats(self):
+        """
+        Returns a dict with the hit and miss counts and the size of the
+        cache.
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'phrases': len(self._entries),
+                    'size': self.size}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_config():
+    # FIXME: Replace this as soon as we have a config module
+    config = {'enabled': True}
+    profile_path = dingdangpath.config('profile.yml')
+    if os.path.exists(profile_path):
+        with open(profile_path, 'r') as f:
+            profile = yaml.safe_load(f)
+            if profile and 'tts_cache' in profile:
+                if 'enabled' in profile['tts_cache']:
+                    config['enabled'] = profile['tts_cache']['enabled']
+                if 'max_size' in profile['tts_cache']:
+                    # in MB
+                    config['max_size'] = \
+                        int(profile['tts_cache']['max_size'] * 1024 * 1024)
+    return config
+
+
+def get_tts_cache():
+    """
+    Returns the TTSCache shared by the whole process, or None if it is
+    disabled by the tts_cache section of the profile.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            config = get_config()
+            if not config.pop('enabled'):
+                return None
+            _cache = TTSCache(dingdangpath.config('tts_cache'), **config)
+        return _cache
@@ -0,0 +1,105 @@
+# -*- coding: utf-8-*-
+"""
+    Preparation of recorded utterances for upload to cloud STT services.
+
+    The silence around the speech is trimmed, the audio can be downsampled
+    and compressed with an external encoder (sox or flac), so that fewer
+    bytes have to go over slow uplinks.
+"""
+import audioop
+import logging
+import subprocess
+
+import diagnose
+from audioclip import AudioClip
+from player import convert
+
+_logger = logging.getLogger(__name__)
+
+# codec -- (executable, arguments); '%(rate)d' is replaced by the sample rate
+ENCODERS = {
+    'flac': [('flac', ['--silent', '--force-raw-format', '--endian=little',
+                       '--sign=signed', '--channels=1', '--bps=16',
+                       '--sample-rate=%(rate)d', '-o', '-', '-']),
+             ('sox', ['-t', 'raw', '-r', '%(rate)d', '-e', 'signed',
+                      '-b', '16', '-c', '1', '-', '-t', 'flac', '-'])],
+    'amr-nb': [('sox', ['-t', 'raw', '-r', '%(rate)d', '-e', 'signed',
+                        '-b', '16', '-c', '1', '-', '-t', 'amr-nb', '-'])]
+}
+# encoders that failed once aren't tried again
+_broken = set()
+
+
+def trim_silence(clip, frame_ms=20, margin=0.2, ratio=3.0, min_level=100):
+    """
+    Returns the part of clip between the first and the last frame that is
+    louder than the background, plus margin seconds on both sides. The
+    background level is taken from the quietest tenth of the frames.
+
+    Arguments:
+    clip -- a mono AudioClip
+    frame_ms -- length of the frames the level is measured on
+    margin -- seconds of audio kept around the speech
+    ratio -- factor by which speech is louder than the background
+    min_level -- lowest RMS level that counts as speech
+    """
+    frame_size = clip.rate * frame_ms / 1000 * clip.frame_width
+    data = clip.buffer()
+    levels = [audioop.rms(data[i:i + frame_size], clip.sample_width)
+              for i in xrange(0, len(clip), frame_size)]
+    if not levels:
+        return clip
+    background = sorted(levels)[len(levels) / 10]
+    threshold = max(min_level, background * ratio)
+    loud = [i for i, level in enumerate(levels) if level > threshold]
+    if not loud:
+        return clip
+    margin_frames = int(margin * 1000 / frame_ms)
+    start = max(0, loud[0] - margin_frames) * frame_size
+    end = min(len(levels), loud[-1] + 1 + margin_frames) * frame_size
+    if start == 0 and end >= len(clip):
+        return clip
+    return AudioClip(clip.view(start, end), rate=clip.rate,
+                     sample_width=clip.sample_width, channels=clip.channels)
+
+
+def resample(clip, rate):
+    """
+    Returns clip as 16 bit mono audio with the given sample rate.
+    """
+    if clip.rate == rate and clip.channels == 1 and clip.sample_width == 2:
+        return clip
+    return convert(clip, rate, 1, 2)
+
+
+def encode(clip, codec):
+    """
+    Compresses 16 bit mono audio with the first working encoder for codec.
+
+    Returns:
+        The encoded audio as str, or None if no encoder is available
+    """
+    for executable, args in ENCODERS.get(codec, []):
+        if (executable, codec) in _broken:
+            continue
+        if not diagnose.check_executable(executable):
+            _broken.add((executable, codec))
+            continue
+        cmd = [executable] + [arg % {'rate': clip.rate} for arg in args]
+        try:
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            output, errors = p.communicate(clip.bytes())
+        except OSError, e:
+            errors = str(e)
+            output = None
+        else:
+            if p.returncode != 0:
+                output = None
+        if output:
+            return output
+        _logger.warning("Can't encode %s with %s: %s", codec, executable,
+                        errors.strip())
+        _broken.add((executable, codec))
+    return None
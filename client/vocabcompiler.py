@@ -17,6 +17,7 @@ from abc import ABCMeta, abstractmethod, abstractproperty
 import yaml
 
 import brain
+import diagnose
 import dingdangpath
 
 from g2p import PhonetisaurusG2P
@@ -226,6 +227,27 @@ class PocketsphinxVocabulary(AbstractVocabulary):
         """
         return os.path.join(self.path, 'dictionary')
 
+    @property
+    def binary_languagemodel_file(self):
+        """
+        Returns:
+            The path of the binary languagemodel converted from the compiled
+            revision as string, or None if there is none
+        """
+        return find_binary_languagemodel(self.languagemodel_file,
+                                         self.compiled_revision)
+
+    @property
+    def has_binary_languagemodel(self):
+        """
+        Checks if a binary languagemodel exists and was converted from the
+        compiled revision.
+
+        Returns:
+            True if the binary languagemodel can be used, else False
+        """
+        return self.binary_languagemodel_file is not None
+
     @property
     def is_compiled(self):
         """
@@ -254,7 +276,8 @@ class PocketsphinxVocabulary(AbstractVocabulary):
                                            hmm='/path/to/hmm')
 
         """
-        return {'lm': self.languagemodel_file, 'dict': self.dictionary_file}
+        lm = self.binary_languagemodel_file or self.languagemodel_file
+        return {'lm': lm, 'dict': self.dictionary_file}
 
     def _compile_vocabulary(self, phrases):
         """
@@ -269,6 +292,30 @@ class PocketsphinxVocabulary(AbstractVocabulary):
         vocabulary = self._compile_languagemodel(text, self.languagemodel_file)
         self._logger.debug('Starting dictionary...')
         self._compile_dictionary(vocabulary, self.dictionary_file)
+        # a forced recompilation keeps the revision, drop the stale binary
+        for ofmt, suffix in BINARY_FORMATS:
+            revision_file = self.languagemodel_file + suffix + '.revision'
+            if os.path.exists(revision_file):
+                os.remove(revision_file)
+        self.compile_binary_languagemodel()
+
+    def compile_binary_languagemodel(self):
+        """
+        Converts the compiled languagemodel to a binary format (see
+        convert_languagemodel()), which the decoder loads much faster than
+        the ARPA text format.
+
+        Returns:
+            True if the binary languagemodel is up to date, else False
+        """
+        if self.has_binary_languagemodel:
+            return True
+        revision = self.compiled_revision
+        if revision is None:
+            return False
+        return convert_languagemodel(self.languagemodel_file,
+                                     self.languagemodel_file,
+                                     revision) is not None
 
     def _compile_languagemodel(self, text, output_file):
         """
@@ -321,8 +368,9 @@ class PocketsphinxVocabulary(AbstractVocabulary):
         phonemes = g2pconverter.translate(words)
 
         self._logger.debug("Creating dict file: '%s'", output_file)
+        # sorted, so the decoder's dictionary hash is filled in order
         with open(output_file, "w") as f:
-            for word, pronounciations in phonemes.items():
+            for word, pronounciations in sorted(phonemes.items()):
                 for i, pronounciation in enumerate(pronounciations, start=1):
                     if i == 1:
                         line = "%s\t%s\n" % (word, pronounciation)
@@ -489,6 +537,109 @@ def get_phrases_from_plugin(plugin):
     return plugin.WORDS if hasattr(plugin, 'WORDS') else []
 
 
+# sphinx_lm_convert output formats and the suffixes of the files they are
+# written to, in order of preference: sphinxbase 5prealpha writes only ARPA
+# and BIN, sphinxbase 0.8 doesn't know BIN yet but writes DMP
+BINARY_FORMATS = (('bin', '.lm.bin'), ('dmp', '.DMP'))
+
+
+def find_binary_languagemodel(base, revision):
+    """
+    Returns the binary languagemodel converted from revision of a
+    languagemodel (see convert_languagemodel()), or None if there is none.
+
+    Arguments:
+        base -- path of the binary files without the suffix
+        revision -- the revision of the text languagemodel
+    """
+    if revision is None:
+        return None
+    for ofmt, suffix in BINARY_FORMATS:
+        path = base + suffix
+        revision_file = path + '.revision'
+        if not os.access(path, os.R_OK) or \
+           not os.access(revision_file, os.R_OK):
+            continue
+        with open(revision_file, 'r') as f:
+            if f.read().strip() == revision:
+                return path
+    return None
+
+
+def convert_languagemodel(lm_file, base, revision):
+    """
+    Converts an ARPA languagemodel to the first binary format in
+    BINARY_FORMATS that sphinx_lm_convert (from sphinxbase) can write, and
+    notes the revision it was converted from next to it.
+
+    Arguments:
+        lm_file -- path of the ARPA languagemodel
+        base -- path of the binary file without the suffix
+        revision -- the revision of lm_file
+
+    Returns:
+        The path of the binary languagemodel, or None if it couldn't be
+        converted
+    """
+    logger = logging.getLogger(__name__)
+    if not diagnose.check_executable('sphinx_lm_convert'):
+        logger.debug("sphinx_lm_convert not found, keeping the text " +
+                     "languagemodel only")
+        return None
+    for ofmt, suffix in BINARY_FORMATS:
+        path = base + suffix
+        cmd = ['sphinx_lm_convert',
+               '-i', lm_file,
+               '-o', path,
+               '-ofmt', ofmt]
+        logger.debug("Converting languagemodel: %s", ' '.join(cmd))
+        with tempfile.TemporaryFile() as f:
+            returncode = subprocess.call(cmd, stdout=f, stderr=f)
+            f.seek(0)
+            output = f.read()
+        if returncode == 0 and os.path.exists(path) and \
+           os.path.getsize(path) > 0:
+            with open(path + '.revision', 'w') as f:
+                f.write(revision)
+            return path
+        logger.debug("Couldn't convert languagemodel to %s format: %s",
+                     ofmt, output.strip())
+    logger.warning("Couldn't convert languagemodel '%s' to any binary " +
+                   "format, keeping the text languagemodel only", lm_file)
+    return None
+
+
+def get_static_languagemodel(name):
+    """
+    Returns the languagemodel in the dingdang data dir with the given file
+    name, converted to a binary format in the vocabularies config dir if
+    possible. The conversion is redone whenever the file changes.
+
+    Returns:
+        The path of the binary languagemodel, or of the text one if it
+        couldn't be converted
+    """
+    lm_file = dingdangpath.data(name)
+    with open(lm_file, 'rb') as f:
+        revision = hashlib.sha1(f.read()).hexdigest()
+    path = dingdangpath.config('vocabularies', 'static')
+    if not os.path.exists(path):
+        os.makedirs(path)
+    base = os.path.join(path, os.path.splitext(name)[0])
+    binary = find_binary_languagemodel(base, revision)
+    if binary is None:
+        binary = convert_languagemodel(lm_file, base, revision)
+    return binary or lm_file
+
+
+def get_persona_languagemodel():
+    """
+    Returns the languagemodel of the persona (static/languagemodel_persona.lm)
+    in the format that loads fastest, see get_static_languagemodel().
+    """
+    return get_static_languagemodel('languagemodel_persona.lm')
+
+
 def get_keyword_phrases():
     """
     Gets the keyword phrases from the keywords file in the dingdang data dir.
@@ -524,6 +675,43 @@ def get_all_phrases():
     return sorted(list(set(phrases)))
 
 
+def benchmark_decoder(vocab, hmm_dir, runs=5):
+    """
+    Prints how long pocketsphinx takes to create a decoder for vocab, once
+    with the text and once with the binary languagemodel.
+    """
+    import time
+    # quirky bug where first import doesn't work
+    try:
+        import pocketsphinx as ps
+    except Exception:
+        import pocketsphinx as ps
+
+    if not vocab.compile_binary_languagemodel():
+        print("Can't benchmark without the binary languagemodel")
+        return
+    devnull = os.devnull
+    for label, lm in (('text', vocab.languagemodel_file),
+                      ('binary', vocab.binary_languagemodel_file)):
+        times = []
+        for i in range(runs):
+            start = time.time()
+            if hasattr(ps.Decoder, 'default_config'):
+                config = ps.Decoder.default_config()
+                config.set_string('-hmm', hmm_dir)
+                config.set_string('-lm', lm)
+                config.set_string('-dict', vocab.dictionary_file)
+                config.set_string('-logfn', devnull)
+                ps.Decoder(config)
+            else:
+                ps.Decoder(hmm=hmm_dir, lm=lm, dict=vocab.dictionary_file,
+                           logfn=devnull)
+            times.append(time.time() - start)
+        print("Decoder init (%s): min %d ms, mean %d ms (%d runs)" %
+              (label, min(times) * 1000, sum(times) / len(times) * 1000,
+               runs))
+
+
 if __name__ == '__main__':
     import argparse
 
@@ -533,6 +721,9 @@ if __name__ == '__main__':
                              'compiled.')
     parser.add_argument('--debug', action='store_true',
                         help='show debug messages')
+    parser.add_argument('--benchmark', action='store', metavar='HMM_DIR',
+                        help='measure the decoder startup time with the ' +
+                             'text and the binary languagemodel')
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
@@ -559,6 +750,10 @@ if __name__ == '__main__':
                 print("Is compiled:       %r" % vocab.is_compiled)
                 print("Matches phrases:   %r" % vocab.matches_phrases(phrases))
                 print("")
+            if args.benchmark and isinstance(vocab, PocketsphinxVocabulary):
+                benchmark_decoder(vocab, args.benchmark)
+                print("")
+    print("Persona languagemodel: %s" % get_persona_languagemodel())
     if not args.base_dir:
         print("Removing temporary directory '%s'..." % base_dir)
         shutil.rmtree(base_dir)
@@ -8,6 +8,7 @@ import sys
 import yaml
 
 from client import dingdangpath
+from client import prerender
 from client import stt
 from client import tts
 from client.conversation import Conversation
@@ -85,6 +86,11 @@ class Dingdang(object):
             persona = self.config["robot_name"]
         conversation = Conversation(persona, self.mic, self.config)
         self.mic.say(salutation)
+        if self.config.get('tts_cache', {}).get('prerender', True):
+            brain = conversation.brain
+            plugins = [plugin for plugin in brain.plugins
+                       if brain.isEnabled(plugin)]
+            prerender.start(self.mic.speaker, prerender.get_phrases(plugins))
         conversation.handleForever()
 
 
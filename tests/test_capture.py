@@ -0,0 +1,80 @@
+# -*- coding: utf-8-*-
+import threading
+import time
+import unittest
+
+from client import capture
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = capture.RingBuffer(10)
+
+    def test_read(self):
+        self.ring.write('abcdef')
+        self.assertEqual(self.ring.read(0, 4, timeout=0), ('abcd', 4))
+        self.assertEqual(self.ring.read(4, 2, timeout=0), ('ef', 6))
+
+    def test_positions(self):
+        self.assertEqual(self.ring.position, 0)
+        self.assertEqual(self.ring.oldest, 0)
+        self.ring.write('abcdef')
+        self.ring.write('ghijkl')
+        self.assertEqual(self.ring.position, 12)
+        self.assertEqual(self.ring.oldest, 2)
+
+    def test_wrap_around(self):
+        self.ring.write('abcdefgh')
+        self.ring.write('ijklmn')
+        # the second write wraps around the end of the buffer
+        self.assertEqual(self.ring.read(4, 10, timeout=0),
+                         ('efghijklmn', 14))
+        self.assertEqual(self.ring.read(8, 4, timeout=0), ('ijkl', 12))
+
+    def test_oversized_write(self):
+        self.ring.write('0123456789abcdef')
+        self.assertEqual(self.ring.position, 16)
+        self.assertEqual(self.ring.read(6, 10, timeout=0),
+                         ('6789abcdef', 16))
+
+    def test_overwritten_position(self):
+        self.ring.write('abcdefgh')
+        self.ring.write('ijklmn')
+        # reading resumes at the oldest byte still held
+        self.assertEqual(self.ring.read(0, 3, timeout=0), ('efg', 7))
+
+    def test_read_into(self):
+        self.ring.write('abcdefgh')
+        self.ring.write('ijklmn')
+        dest = bytearray('-' * 12)
+        self.assertEqual(self.ring.read_into(6, dest, 1, 8, timeout=0),
+                         (8, 14))
+        self.assertEqual(str(dest), '-ghijklmn---')
+
+    def test_read_into_nothing(self):
+        dest = bytearray(4)
+        self.assertEqual(self.ring.read_into(0, dest, 0, 4, timeout=0),
+                         (0, 0))
+
+    def test_read_timeout(self):
+        self.ring.write('abc')
+        start = time.time()
+        self.assertEqual(self.ring.read(0, 5, timeout=0.05), ('abc', 3))
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+    def test_read_waits_for_data(self):
+        timer = threading.Timer(0.05, self.ring.write, ('abcd',))
+        timer.start()
+        try:
+            self.assertEqual(self.ring.read(0, 4, timeout=5), ('abcd', 4))
+        finally:
+            timer.join()
+
+    def test_close_wakes_readers(self):
+        timer = threading.Timer(0.05, self.ring.close)
+        timer.start()
+        try:
+            self.assertEqual(self.ring.read(0, 4), ('', 0))
+        finally:
+            timer.join()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8-*-
+import math
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+import wave
+
+from client import audiosource
+from client import capture
+from client import mic
+
+
+def write_wav(path, samples, rate=16000):
+    wav_fp = wave.open(path, 'wb')
+    try:
+        wav_fp.setnchannels(1)
+        wav_fp.setsampwidth(2)
+        wav_fp.setframerate(rate)
+        wav_fp.writeframes(struct.pack('<%dh' % len(samples), *samples))
+    finally:
+        wav_fp.close()
+
+
+def tone(seconds, amplitude=8000, rate=16000):
+    return [int(amplitude * math.sin(2 * math.pi * 440 * i / rate))
+            for i in range(int(seconds * rate))]
+
+
+def noise(seconds, amplitude=30, rate=16000):
+    rand = random.Random(0)
+    return [rand.randint(-amplitude, amplitude)
+            for i in range(int(seconds * rate))]
+
+
+class TestEndpointer(unittest.TestCase):
+
+    THRESHOLD = 100
+    # replays the audio faster than real time
+    SPEED = 20
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # quiet background, so the gaps aren't taken for muted audio
+        self.noise = os.path.join(self.tmpdir, 'noise.wav')
+        write_wav(self.noise, noise(1.0))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def record(self, samples, gap=0.5, **kwargs):
+        """
+        Replays samples through an AudioCapture into an Endpointer until
+        it decides.
+        """
+        path = os.path.join(self.tmpdir, 'utterance.wav')
+        write_wav(path, samples)
+        source = audiosource.WavFileSource(path, speed=self.SPEED, gap=gap,
+                                           noise=self.noise, noise_gain=1)
+        audio = capture.AudioCapture(source)
+        endpointer = mic.Endpointer(mic.EnergyVoiceDetector(self.THRESHOLD),
+                                    **kwargs)
+        stream = audio.reader()
+        try:
+            for i in range(1000):
+                if endpointer.process(stream.read(1024)):
+                    break
+        finally:
+            stream.close()
+            audio.stop()
+        return endpointer
+
+    def test_endpoint(self):
+        endpointer = self.record(tone(1.0), hangover=0.3)
+        self.assertEqual(endpointer.reason, 'endpoint')
+        self.assertTrue(endpointer.speech_started)
+        # 0.5 s gap, 1 s speech, 0.3 s hangover
+        self.assertAlmostEqual(endpointer.decision_time, 1.8, delta=0.05)
+        self.assertAlmostEqual(endpointer.decision_delay, 0.3, delta=0.05)
+
+    def test_short_pause(self):
+        samples = tone(0.5) + noise(0.2) + tone(0.5)
+        endpointer = self.record(samples, hangover=0.3)
+        # the pause is shorter than the hangover
+        self.assertEqual(endpointer.reason, 'endpoint')
+        self.assertAlmostEqual(endpointer.decision_time, 2.0, delta=0.05)
+
+    def test_timeout(self):
+        endpointer = self.record(noise(2.0), start_timeout=1)
+        self.assertEqual(endpointer.reason, 'timeout')
+        self.assertFalse(endpointer.speech_started)
+        self.assertAlmostEqual(endpointer.decision_time, 1.0, delta=0.05)
+
+    def test_max_length(self):
+        endpointer = self.record(tone(3.0), max_length=1.5)
+        self.assertEqual(endpointer.reason, 'max_length')
+        self.assertAlmostEqual(endpointer.decision_time, 1.5, delta=0.05)
+
+    def test_muted_audio(self):
+        endpointer = mic.Endpointer(mic.EnergyVoiceDetector(self.THRESHOLD),
+                                    start_timeout=1)
+        # muted audio is neither speech nor silence, but counts as time
+        self.assertFalse(endpointer.process('\0' * 16000))
+        self.assertTrue(endpointer.process('\0' * 16000))
+        self.assertEqual(endpointer.reason, 'timeout')
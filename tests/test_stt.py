@@ -0,0 +1,128 @@
+# -*- coding: utf-8-*-
+import threading
+import time
+import unittest
+
+from client import stt
+from client.audioclip import AudioClip
+
+
+class FakeSTT(object):
+
+    def __init__(self, slug, delay, hypotheses, confidence=None,
+                 error=None):
+        self.SLUG = slug
+        self.delay = delay
+        self.hypotheses = hypotheses
+        self.confidence = confidence
+        self.error = error
+        self.finished = threading.Event()
+
+    def transcribe_with_confidence(self, clip):
+        try:
+            time.sleep(self.delay)
+            if self.error is not None:
+                raise self.error
+            return (self.hypotheses, self.confidence)
+        finally:
+            self.finished.set()
+
+
+class TestHedgedSTT(unittest.TestCase):
+
+    def setUp(self):
+        self.clip = AudioClip(bytearray(3200))
+        self.engines = []
+
+    def tearDown(self):
+        # let the workers of late engines finish before the next test
+        for engine in self.engines:
+            engine.finished.wait(2)
+
+    def transcribe(self, engines, **kwargs):
+        self.engines = engines
+        hedged = stt.HedgedSTT(engines, **kwargs)
+        start = time.time()
+        result = hedged.transcribe_with_confidence(self.clip)
+        return result, time.time() - start, hedged
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, stt.HedgedSTT, [])
+        self.assertRaises(ValueError, stt.HedgedSTT,
+                          [FakeSTT('a', 0, ['A'])], policy='fastest')
+
+    def test_first(self):
+        result, elapsed, hedged = self.transcribe([
+            FakeSTT('empty', 0, []),
+            FakeSTT('fast', 0.05, ['FAST'], 0.2),
+            FakeSTT('slow', 0.5, ['SLOW'], 0.9)], policy='first')
+        self.assertEqual(result, (['FAST'], 0.2))
+        self.assertLess(elapsed, 0.4)
+        stats = hedged.stats()
+        self.assertEqual(stats['fast']['wins'], 1)
+        self.assertEqual(stats['fast']['win_rate'], 1.0)
+        self.assertEqual(stats['empty']['empty'], 1)
+        self.assertEqual(stats['slow']['cancelled'], 1)
+
+    def test_best(self):
+        result, elapsed, hedged = self.transcribe([
+            FakeSTT('fast', 0, ['FAST'], 0.4),
+            FakeSTT('good', 0.1, ['GOOD'], 0.9),
+            FakeSTT('unknown', 0.05, ['UNKNOWN'])], policy='best')
+        self.assertEqual(result, (['GOOD'], 0.9))
+        self.assertEqual(hedged.stats()['good']['wins'], 1)
+
+    def test_best_deadline(self):
+        result, elapsed, hedged = self.transcribe([
+            FakeSTT('fast', 0, ['FAST'], 0.4),
+            FakeSTT('late', 1, ['LATE'], 0.9)], policy='best',
+            deadline=0.2)
+        self.assertEqual(result, (['FAST'], 0.4))
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(hedged.stats()['late']['cancelled'], 1)
+
+    def test_local_first_confirmed(self):
+        result, elapsed, hedged = self.transcribe([
+            FakeSTT('local', 0, ['HELLO'], 0.6),
+            FakeSTT('cloud', 0.05, ['hello'], 0.9)],
+            policy='local-first', verify_timeout=0.5)
+        self.assertEqual(result, (['HELLO'], 0.6))
+        self.assertLess(elapsed, 0.4)
+
+    def test_local_first_overruled(self):
+        result, elapsed, hedged = self.transcribe([
+            FakeSTT('local', 0, ['HELLO'], 0.6),
+            FakeSTT('cloud', 0.05, ['WORLD'], 0.9)],
+            policy='local-first', verify_timeout=0.5)
+        self.assertEqual(result, (['WORLD'], 0.9))
+
+    def test_local_first_verify_timeout(self):
+        result, elapsed, hedged = self.transcribe([
+            FakeSTT('local', 0, ['HELLO'], 0.6),
+            FakeSTT('cloud', 1, ['WORLD'], 0.9)],
+            policy='local-first', verify_timeout=0.1)
+        self.assertEqual(result, (['HELLO'], 0.6))
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(hedged.stats()['cloud']['cancelled'], 1)
+
+    def test_local_first_fallback(self):
+        result, elapsed, hedged = self.transcribe([
+            FakeSTT('local', 0, []),
+            FakeSTT('cloud', 0.05, ['WORLD'], 0.9)],
+            policy='local-first')
+        self.assertEqual(result, (['WORLD'], 0.9))
+
+    def test_engine_error(self):
+        result, elapsed, hedged = self.transcribe([
+            FakeSTT('broken', 0, ['BROKEN'], error=RuntimeError('boom')),
+            FakeSTT('cloud', 0.05, ['WORLD'], 0.9)], policy='first')
+        self.assertEqual(result, (['WORLD'], 0.9))
+        self.assertEqual(hedged.stats()['broken']['errors'], 1)
+
+    def test_no_result(self):
+        result, elapsed, hedged = self.transcribe([
+            FakeSTT('local', 0, []),
+            FakeSTT('cloud', 0.05, [''])], policy='local-first')
+        self.assertEqual(result, ([], None))
+        stats = hedged.stats()
+        self.assertEqual(stats['local']['wins'] + stats['cloud']['wins'], 0)
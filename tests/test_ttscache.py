@@ -0,0 +1,98 @@
+# -*- coding: utf-8-*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from client import ttscache
+
+
+class TestTTSCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def speech_file(self, size, suffix='.wav'):
+        fd, filename = tempfile.mkstemp(suffix=suffix, dir=self.tmpdir)
+        os.write(fd, 'x' * size)
+        os.close(fd)
+        return filename
+
+    def test_key_normalizes_whitespace(self):
+        key = ttscache.TTSCache.key
+        self.assertEqual(key('baidu-tts', {}, u'你好 叮当'),
+                         key('baidu-tts', {}, u'  你好\n\t叮当 '))
+
+    def test_key_accepts_utf8(self):
+        key = ttscache.TTSCache.key
+        self.assertEqual(key('baidu-tts', {}, u'你好'),
+                         key('baidu-tts', {}, u'你好'.encode('utf-8')))
+
+    def test_key_normalizes_unicode(self):
+        key = ttscache.TTSCache.key
+        self.assertEqual(key('espeak-tts', {}, u'caf\u00e9'),
+                         key('espeak-tts', {}, u'cafe\u0301'))
+
+    def test_key_depends_on_engine_and_params(self):
+        key = ttscache.TTSCache.key
+        keys = set([key('baidu-tts', {'per': 0}, u'你好'),
+                    key('baidu-tts', {'per': 1}, u'你好'),
+                    key('espeak-tts', {'per': 0}, u'你好'),
+                    key('baidu-tts', {'per': 0}, u'您好')])
+        self.assertEqual(len(keys), 4)
+        self.assertEqual(key('baidu-tts', {'per': 0, 'spd': 5}, u'你好'),
+                         key('baidu-tts', {'spd': 5, 'per': 0}, u'你好'))
+
+    def test_put_get(self):
+        cache = ttscache.TTSCache(self.path)
+        filename = self.speech_file(100, '.mp3')
+        cached = cache.put('a', filename)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(cached, os.path.join(self.path, 'a.mp3'))
+        self.assertEqual(cache.get('a'), cached)
+        self.assertIn('a', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1,
+                                         'phrases': 1, 'size': 100})
+
+    def test_removed_file_is_a_miss(self):
+        cache = ttscache.TTSCache(self.path)
+        os.remove(cache.put('a', self.speech_file(100)))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_evicts_least_recently_used(self):
+        cache = ttscache.TTSCache(self.path, max_size=250)
+        a = cache.put('a', self.speech_file(100))
+        cache.put('b', self.speech_file(100))
+        # 'a' is used more recently than 'b' now
+        cache.get('a')
+        cache.put('c', self.speech_file(100))
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertTrue(os.path.exists(a))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'b.wav')))
+        self.assertEqual(cache.stats()['size'], 200)
+
+    def test_keeps_oversized_entry(self):
+        cache = ttscache.TTSCache(self.path, max_size=50)
+        cache.put('a', self.speech_file(100))
+        self.assertIn('a', cache)
+
+    def test_order_survives_reload(self):
+        cache = ttscache.TTSCache(self.path)
+        a = cache.put('a', self.speech_file(100))
+        b = cache.put('b', self.speech_file(100))
+        now = time.time()
+        os.utime(b, (now - 60, now - 60))
+        os.utime(a, (now, now))
+        cache = ttscache.TTSCache(self.path, max_size=150)
+        # loading evicts the least recently used entry
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)